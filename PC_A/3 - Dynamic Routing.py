@@ -1,11 +1,21 @@
 import paho.mqtt.client as mqtt
 import threading
 import time
-from collections import defaultdict
+import heapq
+from collections import Counter, defaultdict
 import json
+from types import MappingProxyType
 import networkx as nx
 import matplotlib.pyplot as plt
 
+# Optional bulk path engine for large (simulated) meshes; the menu falls back to Dijkstra without it
+try:
+    import numpy as np
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+except ImportError:
+    np = None
+
 # Configuration
 BROKER_IP = '172.16.2.130'  # Local broker IP
 DISCOVERY_TOPIC = 'discovery'
@@ -19,11 +29,125 @@ accepted_connections = defaultdict(set)  # Track accepted connections for each n
 connections_list = defaultdict(list)  # List to store connections for each node
 next_hop = None
 topology_algorithm = None
+CSGRAPH_MIN_WEIGHT = 1e-9  # csgraph treats zero entries as missing links, so weights are clamped to this
+CSGRAPH_NO_HOP = -9999  # What scipy's predecessor arrays hold where there is no predecessor
+csr_cache = (None, None)  # (topology version, CSR matrix) so unchanged topologies are not converted again
 connection_list_file = "connections_list.json"
 
+
+# Long-lived topology index shared by the connection handlers and the path algorithms.
+# Every node name gets a small integer id once and its links live in one dict keyed by
+# neighbor id, so connection reports are applied in place instead of rebuilding a graph.
+class TopologyIndex:
+    def __init__(self):
+        self.node_ids = {}  # Node name -> integer id
+        self.node_names = []  # Integer id -> node name
+        self.adjacency = []  # Integer id -> {neighbor id: latency}, kept symmetric
+        self.version = 0  # Bumped on every change so readers can tell a snapshot is stale
+
+    def node_id(self, name):
+        node_id = self.node_ids.get(name)
+        if node_id is None:
+            node_id = len(self.node_names)
+            self.node_ids[name] = node_id
+            self.node_names.append(name)
+            self.adjacency.append({})
+        return node_id
+
+    def neighbors(self, node_id):
+        return self.adjacency[node_id]
+
+    # Returns the previous weight of the link, or None if it is new
+    def set_link(self, u, v, weight):
+        old_weight = self.adjacency[u].get(v)
+        if old_weight != weight:
+            self.adjacency[u][v] = weight
+            self.adjacency[v][u] = weight
+            self.version += 1
+        return old_weight
+
+    def remove_link(self, u, v):
+        if v not in self.adjacency[u]:
+            return False
+        del self.adjacency[u][v]
+        del self.adjacency[v][u]
+        self.version += 1
+        return True
+
+    def clear(self):
+        for links in self.adjacency:
+            links.clear()
+        self.version += 1
+
+    def snapshot(self):
+        return TopologySnapshot(self)
+
+
+# Read-only view of the topology index for the path algorithms. Creating one is O(1);
+# it reflects the index at `version` and should not be held across further updates.
+class TopologySnapshot:
+    def __init__(self, index):
+        self.version = index.version
+        self.node_ids = MappingProxyType(index.node_ids)
+        self._node_names = index.node_names
+        self._adjacency = index.adjacency
+
+    def __len__(self):
+        return len(self._node_names)
+
+    def name(self, node_id):
+        return self._node_names[node_id]
+
+    def neighbors(self, node_id):
+        return MappingProxyType(self._adjacency[node_id])
+
+    def nodes(self):
+        return [node_id for node_id, links in enumerate(self._adjacency) if links]
+
+    def edges(self):
+        for u, links in enumerate(self._adjacency):
+            for v, weight in links.items():
+                if u < v:
+                    yield u, v, weight
+
+    # networkx graph with node names, only built when the network is displayed
+    def to_graph(self):
+        G = nx.Graph()
+        for u, v, weight in self.edges():
+            G.add_edge(self._node_names[u], self._node_names[v], weight=weight, label=f"{weight:.4f}")
+        return G
+
+
+topology = TopologyIndex()
+
+# Node positions are only needed when the graph is displayed, so they are computed on demand
+# and cached; after small topology changes the previous positions seed a short re-layout
+LAYOUT_WARM_START_ITERATIONS = 15  # spring_layout iterations when warm starting (default is 50)
+LAYOUT_WARM_START_MAX_CHANGE = 0.2  # Fraction of new nodes up to which the old positions are reused
+layout_positions = {}
+layout_dirty = True
+
+
+def invalidate_layout():
+    global layout_dirty
+    layout_dirty = True
+
+
 # Define a global layout for node positions
 def get_fixed_layout(G):
-    return nx.spring_layout(G, seed=42)  # Use a seed for reproducible positions
+    global layout_positions, layout_dirty
+    nodes = set(G.nodes)
+    if not layout_dirty and nodes == set(layout_positions):
+        return layout_positions
+
+    previous = {node: layout_positions[node] for node in nodes if node in layout_positions}
+    new_nodes = len(nodes) - len(previous)
+    if previous and new_nodes <= LAYOUT_WARM_START_MAX_CHANGE * len(nodes):
+        layout_positions = nx.spring_layout(G, pos=previous, iterations=LAYOUT_WARM_START_ITERATIONS, seed=42)
+    else:
+        layout_positions = nx.spring_layout(G, seed=42)  # Use a seed for reproducible positions
+    layout_dirty = False
+    return layout_positions
 
 
 # Periodically broadcast presence for neighbor discovery
@@ -98,6 +222,8 @@ def add_local_connection(neighbor, latency):
             connections_list[neighbor] = []
         connections_list[NODE_NAME].append((neighbor, latency))
         connections_list[neighbor].append((NODE_NAME, latency))
+        topology.set_link(topology.node_id(NODE_NAME), topology.node_id(neighbor), latency)
+        invalidate_layout()
         print(f"Added connection with {neighbor} with latency {latency}")
     else:
         print(f"Connection with {neighbor} already exists")
@@ -188,7 +314,7 @@ def on_message(client, userdata, msg):
 
     if topic_parts[0] == 'connections' and topic_parts[1] == GATEWAY_NODE:
         node, connections_info = payload.split(':', 1)
-        connections_list[node] = []
+        reported_connections = []
         for info in connections_info.split(','):
             if ':' in info:
                 parts = info.split(':')
@@ -196,7 +322,7 @@ def on_message(client, userdata, msg):
                     neighbor, latency = parts
                     try:
                         latency = float(latency)
-                        connections_list[node].append((neighbor, latency))
+                        reported_connections.append((neighbor, latency))
                         latencies[node][neighbor] = latency
                         latencies[neighbor][node] = latency
                     except ValueError:
@@ -205,7 +331,9 @@ def on_message(client, userdata, msg):
                     print(f"Warning: Info string does not contain exactly two parts separated by ':': {info}")
             else:
                 print(f"Warning: Info string does not contain ':': {info}")
+        apply_connections_report(node, reported_connections)
         print(f"Received connections list with latency from {node}: {connections_list[node]}")
+        invalidate_layout()
         save_connections_to_file()
         if NODE_NAME == GATEWAY_NODE:
             calculate_and_broadcast_next_hops()
@@ -254,7 +382,7 @@ def on_message(client, userdata, msg):
 
 
 def recompute_shortest_paths():
-    path, G, pos = find_shortest_path_to_gateway()
+    path = find_shortest_path_to_gateway()
     if path:
         print(f"Recomputed shortest path: {' -> '.join(path)}")
     else:
@@ -272,13 +400,20 @@ def handle_node_departure(departed_node):
     else:
         print(f"Node {departed_node} not found in connections list.")
 
-    # Iterate through all remaining nodes in the connections list
-    for node, connections in list(connections_list.items()):
-        # Update the connections for each node by removing any that involve the departed node
-        updated_connections = [conn for conn in connections if conn[0] != departed_node]
-        if len(updated_connections) != len(connections):
-            print(f"Updating connections for node {node}.")
-        connections_list[node] = updated_connections
+    departed_id = topology.node_ids.get(departed_node)
+    if departed_id is not None:
+        # Only the departed node's neighbours in the topology index can still list it
+        for neighbor_id in list(topology.neighbors(departed_id)):
+            node = topology.node_names[neighbor_id]
+            connections = connections_list.get(node, [])
+            # Update the connections for each node by removing any that involve the departed node
+            updated_connections = [conn for conn in connections if conn[0] != departed_node]
+            if len(updated_connections) != len(connections):
+                print(f"Updating connections for node {node}.")
+                connections_list[node] = updated_connections
+            topology.remove_link(departed_id, neighbor_id)
+
+    invalidate_layout()
 
     # Log the update
     print(f"Updated connections list after {departed_node} departure: {connections_list}")
@@ -312,6 +447,24 @@ def load_connections_from_file():
         return defaultdict(list)
 
 
+# Replace the connections reported by node and apply only the differences to the topology index
+def apply_connections_report(node, reported_connections):
+    old_links = dict(connections_list[node])
+    new_links = dict(reported_connections)
+    connections_list[node] = reported_connections
+    node_id = topology.node_id(node)
+    for neighbor, latency in new_links.items():
+        if old_links.get(neighbor) != latency:
+            topology.set_link(node_id, topology.node_id(neighbor), latency)
+    for neighbor in old_links.keys() - new_links.keys():
+        # The link survives while the other end still reports it
+        reverse_links = dict(connections_list.get(neighbor, []))
+        if node in reverse_links:
+            topology.set_link(node_id, topology.node_id(neighbor), reverse_links[node])
+        else:
+            topology.remove_link(node_id, topology.node_id(neighbor))
+
+
 # Connect to the MQTT broker
 client = mqtt.Client()
 
@@ -351,28 +504,18 @@ def broadcast_departure():
 
 # Function to find the shortest path to the gateway
 def find_shortest_path_to_gateway():
-    G = nx.Graph()
-    G.add_node(NODE_NAME)
-    print("Building graph with nodes:")
-    for node, connections in connections_list.items():
-        print(f"Node: {node}, Connections: {connections}")
-        for neighbor, latency in connections:
-            G.add_edge(node, neighbor, weight=latency, label=f"{latency:.4f}")
-
-    pos = get_fixed_layout(G)
-
-    print(f"Graph nodes: {list(G.nodes)}")
-    print(f"Graph edges: {list(G.edges)}")
+    snapshot = topology.snapshot()
+    print(f"Graph nodes: {[snapshot.name(node) for node in snapshot.nodes()]}")
 
-    if nx.has_path(G, NODE_NAME, GATEWAY_NODE):
-        shortest_path = nx.shortest_path(G, source=NODE_NAME, target=GATEWAY_NODE, weight='weight')
+    shortest_paths, _ = calculate_shortest_paths_dijkstra(snapshot, GATEWAY_NODE)
+    if NODE_NAME in shortest_paths:
+        # Links are symmetric, so the path from the gateway reversed is the path to it
+        shortest_path = shortest_paths[NODE_NAME][::-1]
         print(f"Shortest path to the gateway ({GATEWAY_NODE}): {' -> '.join(shortest_path)}")
-        return shortest_path, G, pos
+        return shortest_path
     else:
         print(f"No path found to the gateway ({GATEWAY_NODE}) from {NODE_NAME}")
-        return None, G, pos
-
-
+        return None
 
 
 # Function to forward a message
@@ -383,33 +526,132 @@ def forward_message_to_next_hop(message, source):
     full_message = f"{source}:{message}"
     client.publish(f"message/{hop}", full_message)
     print(f"Forwarded message to {hop}")
-def calculate_shortest_paths_dijkstra(connections_list, start_node):
-    # Build the graph from connections_list
-    G = nx.Graph()
-    for node, connections in connections_list.items():
-        for neighbor, latency in connections:
-            G.add_edge(node, neighbor, weight=latency, label=f'{latency:.2f}')
-    # Calculate shortest paths
-    shortest_paths = nx.single_source_dijkstra_path(G, start_node, weight='weight')
+# Turn the predecessor map of a single-source search into named paths and path edges
+def build_shortest_paths(snapshot, start, parent):
+    paths = {start: [snapshot.name(start)]}
     shortest_path_edges = set()
-    for target_node, path in shortest_paths.items():
-        for i in range(len(path) - 1):
-            shortest_path_edges.add((path[i], path[i + 1]))
-    return shortest_paths, shortest_path_edges
-
-def calculate_shortest_paths_bellman_ford(connections_list, start_node):
-    # Build the graph from connections_list
-    G = nx.DiGraph()
-    for node, connections in connections_list.items():
-        for neighbor, latency in connections:
-            G.add_edge(node, neighbor, weight=latency, label=f'{latency:.2f}')
-    # Calculate shortest paths
-    shortest_paths = nx.single_source_bellman_ford_path(G, start_node, weight='weight')
-    shortest_path_edges = set()
-    for target_node, path in shortest_paths.items():
-        for i in range(len(path) - 1):
-            shortest_path_edges.add((path[i], path[i + 1]))
-    return shortest_paths, shortest_path_edges
+    for node in parent:
+        # Walk up until a node with a known path, then fill the paths back down
+        chain = []
+        while node not in paths:
+            chain.append(node)
+            node = parent[node]
+        for child in reversed(chain):
+            paths[child] = paths[node] + [snapshot.name(child)]
+            shortest_path_edges.add((snapshot.name(node), snapshot.name(child)))
+            node = child
+    return {snapshot.name(node): path for node, path in paths.items()}, shortest_path_edges
+
+
+def calculate_shortest_paths_dijkstra(snapshot, start_node):
+    start = snapshot.node_ids.get(start_node)
+    if start is None:
+        return {start_node: [start_node]}, set()
+    distance = {start: 0.0}
+    parent = {}
+    heap = [(0.0, start)]
+    while heap:
+        cost, node = heapq.heappop(heap)
+        if cost > distance[node]:
+            continue
+        for neighbor, latency in snapshot.neighbors(node).items():
+            candidate = cost + latency
+            if candidate < distance.get(neighbor, float('inf')):
+                distance[neighbor] = candidate
+                parent[neighbor] = node
+                heapq.heappush(heap, (candidate, neighbor))
+    return build_shortest_paths(snapshot, start, parent)
+
+
+def calculate_shortest_paths_bellman_ford(snapshot, start_node):
+    start = snapshot.node_ids.get(start_node)
+    if start is None:
+        return {start_node: [start_node]}, set()
+    edges = list(snapshot.edges())
+    distance = {start: 0.0}
+    parent = {}
+    for _ in range(len(snapshot) - 1):
+        updated = False
+        for u, v, latency in edges:
+            for a, b in ((u, v), (v, u)):
+                if a in distance and distance[a] + latency < distance.get(b, float('inf')):
+                    distance[b] = distance[a] + latency
+                    parent[b] = a
+                    updated = True
+        if not updated:
+            break
+    return build_shortest_paths(snapshot, start, parent)
+
+
+# CSR adjacency matrix of the topology, indexed by the topology index's integer node ids
+def topology_to_csr(snapshot):
+    global csr_cache
+    version, matrix = csr_cache
+    if version == snapshot.version and matrix.shape[0] == len(snapshot):
+        return matrix
+    rows, cols, weights = [], [], []
+    for u, v, latency in snapshot.edges():
+        rows += (u, v)
+        cols += (v, u)
+        weights += (latency, latency)
+    weights = np.maximum(np.asarray(weights, dtype=float), CSGRAPH_MIN_WEIGHT)
+    matrix = csr_matrix((weights, (rows, cols)), shape=(len(snapshot), len(snapshot)))
+    csr_cache = (snapshot.version, matrix)
+    return matrix
+
+
+# Same result as calculate_shortest_paths_dijkstra, computed by scipy on the CSR matrix
+def calculate_shortest_paths_csgraph(snapshot, start_node):
+    start = snapshot.node_ids.get(start_node)
+    if start is None:
+        return {start_node: [start_node]}, set()
+    _, predecessors = csgraph_dijkstra(topology_to_csr(snapshot), indices=start, return_predecessors=True)
+    reachable = np.flatnonzero(predecessors != CSGRAPH_NO_HOP)
+    parent = dict(zip(reachable.tolist(), predecessors[reachable].tolist()))
+    return build_shortest_paths(snapshot, start, parent)
+
+
+# Next hop of every node towards target ({node: next hop}), straight from the predecessor array:
+# links are symmetric, so a node's predecessor on the path from target is its next hop to it
+def calculate_next_hops_csgraph(snapshot, target_node):
+    target = snapshot.node_ids.get(target_node)
+    if target is None:
+        return {}
+    _, predecessors = csgraph_dijkstra(topology_to_csr(snapshot), indices=target, return_predecessors=True)
+    reachable = np.flatnonzero(predecessors != CSGRAPH_NO_HOP)
+    return {snapshot.name(node): snapshot.name(hop) for node, hop in zip(reachable.tolist(), predecessors[reachable].tolist())}
+
+
+# All-pairs routes for capacity planning. Returns (distances, next_hops) matrices indexed by node id:
+# next_hops[i, j] is the id of i's next hop towards j, or CSGRAPH_NO_HOP if j is unreachable from i
+# (or i == j). Row i of the predecessor matrix is the tree rooted at i, so its transpose holds next hops.
+def calculate_all_pairs_next_hops_csgraph(snapshot):
+    distances, predecessors = csgraph_dijkstra(topology_to_csr(snapshot), return_predecessors=True)
+    return distances, predecessors.T
+
+
+# The 'routes' command: for every node, how many destinations it reaches and how its traffic to
+# them would be spread over its neighbors
+def print_all_pairs_routes():
+    if np is None:
+        print("NumPy/SciPy are not installed, all-pairs routes are not available.")
+        return
+    snapshot = topology.snapshot()
+    nodes = snapshot.nodes()
+    if not nodes:
+        print("No connections available for calculating routes.")
+        return
+    distances, next_hops = calculate_all_pairs_next_hops_csgraph(snapshot)
+    for node in nodes:
+        hops = next_hops[node][nodes]
+        routed = hops != CSGRAPH_NO_HOP
+        if not routed.any():
+            print(f"{snapshot.name(node)}: no routes")
+            continue
+        load = Counter(snapshot.name(hop) for hop in hops[routed].tolist())
+        farthest = distances[node][nodes][routed].max()
+        spread = ', '.join(f"{hop} ({count})" for hop, count in load.most_common())
+        print(f"{snapshot.name(node)}: {routed.sum()} destinations, farthest {farthest:.4f}, via {spread}")
 
 
 def calculate_and_broadcast_next_hops():
@@ -418,28 +660,30 @@ def calculate_and_broadcast_next_hops():
         print("No connections available for calculating shortest paths.")
         return
     if topology_algorithm == 'dijkstra':
-        shortest_paths, shortest_path_edges = calculate_shortest_paths_dijkstra(connections_list, GATEWAY_NODE)
+        shortest_paths, shortest_path_edges = calculate_shortest_paths_dijkstra(topology.snapshot(), GATEWAY_NODE)
     elif topology_algorithm == 'bellman_ford':
-        shortest_paths, shortest_path_edges = calculate_shortest_paths_bellman_ford(connections_list, GATEWAY_NODE)
+        shortest_paths, shortest_path_edges = calculate_shortest_paths_bellman_ford(topology.snapshot(), GATEWAY_NODE)
+    elif topology_algorithm == 'csgraph':
+        # Only this node's next hop is used, so the paths themselves are not built
+        hop = calculate_next_hops_csgraph(topology.snapshot(), GATEWAY_NODE).get(NODE_NAME)
+        if hop is not None:
+            next_hop = hop
+            print(f"Next hop for {NODE_NAME} is {next_hop}")
+        return
     else:
         print(f"Unknown topology algorithm: {topology_algorithm}")
         return
 
     if NODE_NAME in shortest_paths:
+        # The paths run from the gateway, so our next hop is the node before us, as with csgraph
         path = shortest_paths[NODE_NAME]
         if len(path) > 1:
-            next_hop = path[1]
+            next_hop = path[-2]
             print(f"Next hop for {NODE_NAME} is {next_hop}")
 
-    # Build the graph from connections_list
-    G = nx.Graph()
-    for node, connections in connections_list.items():
-        for neighbor, latency in connections:
-            G.add_edge(node, neighbor, weight=latency, label=f'{latency:.2f}')
-
-    # Display the network graph
-    pos = get_fixed_layout(G)
-    # display_network_graph(G, pos, shortest_path_edges)
+    # Display the network graph (the graph and its layout are only built when actually displayed)
+    # G = topology.snapshot().to_graph()
+    # display_network_graph(G, get_fixed_layout(G), shortest_path_edges)
 
 
 def reset_connections():
@@ -459,6 +703,8 @@ def reset_connections():
         connection_slots[neighbor] += 1
     accepted_connections[NODE_NAME] = set()
     connections_list = defaultdict(list)  # Reset connections list
+    topology.clear()
+    invalidate_layout()
     save_connections_to_file()
     # Broadcast presence to allow reconnection
     client.publish(DISCOVERY_TOPIC, NODE_NAME)
@@ -486,11 +732,17 @@ def select_topology_algorithm():
     print("Select the topology algorithm:")
     print("1. Dijkstra")
     print("2. Bellman-Ford")
-    choice = input("Enter your choice (1 or 2): ")
+    print("3. SciPy sparse graph (for large meshes)")
+    choice = input("Enter your choice (1, 2 or 3): ")
     if choice == '1':
         topology_algorithm = 'dijkstra'
     elif choice == '2':
         topology_algorithm = 'bellman_ford'
+    elif choice == '3' and np is None:
+        print("NumPy/SciPy are not installed. Using Dijkstra instead.")
+        topology_algorithm = 'dijkstra'
+    elif choice == '3':
+        topology_algorithm = 'csgraph'
     else:
         print("Invalid choice. Using Dijkstra as the default algorithm.")
         topology_algorithm = 'dijkstra'
@@ -502,7 +754,7 @@ try:
         select_topology_algorithm()
     while True:
         client.on_message = on_message
-        user_input = input("Enter a command (send <message> / show / leave /  reset): ")
+        user_input = input("Enter a command (send <message> / show / routes / leave /  reset): ")
         if user_input.startswith("send "):
             message = user_input[5:]
             forward_message_to_next_hop(message, NODE_NAME)
@@ -513,8 +765,11 @@ try:
             print(connection_slots)
             print(connections_list)
             print(next_hop)
-            _, G, pos = find_shortest_path_to_gateway()
-            display_network_graph(G, pos)
+            find_shortest_path_to_gateway()
+            G = topology.snapshot().to_graph()
+            display_network_graph(G, get_fixed_layout(G))
+        elif user_input == "routes":
+            print_all_pairs_routes()
         elif user_input == "leave":
             leave_network()
             with open(connection_list_file, 'w') as f:
@@ -529,7 +784,7 @@ try:
 except KeyboardInterrupt:
     leave_network()
     with open(connection_list_file, 'w') as f:
-        f.truncate()
+        json.dump({}, f)
     print("Interrupted by user")
 
 
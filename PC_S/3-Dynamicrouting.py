@@ -1,38 +1,535 @@
 import paho.mqtt.client as mqtt
+import asyncio
 import threading
 import time
 import heapq
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple, OrderedDict
+import statistics
 import json
+import math
+import os
+import queue
+import struct
+import zlib
+from types import MappingProxyType
 import networkx as nx
 import matplotlib.pyplot as plt
 
-# Configuration
-BROKER_IP = '172.16.2.153'  # Local broker IP
+# Configuration; the MESH_* environment variables override the defaults so one copy of the script
+# can run as any node (4-Simulation.py starts many nodes this way)
+BROKER_IP = os.environ.get('MESH_BROKER_IP', '172.16.2.153')  # Local broker IP
 DISCOVERY_TOPIC = 'discovery'
-NODE_NAME = 'S'  # Change this for each node ('D', 'S', 'N', 'K')
-GATEWAY_NODE = 'N'  # Specify the gateway node here
+NODE_NAME = os.environ.get('MESH_NODE_NAME', 'S')  # Change this for each node ('D', 'S', 'N', 'K')
+# Specify the gateway nodes here, in order of preference (e.g. ['N', 'K'])
+GATEWAY_NODES = os.environ.get('MESH_GATEWAYS', 'N').split(',')
+GATEWAY_NODE = GATEWAY_NODES[0]  # Connection reports are published to this gateway's topic
+# 'threads' gives the MQTT loop, the sender and every periodic task a thread of its own and waits on
+# input() in the main thread. 'asyncio' runs all of them, timers and handlers on one event loop;
+# start_node(loop) can then be called for many nodes (one module instance each) on the same loop.
+RUNTIME = os.environ.get('MESH_RUNTIME', 'threads')
+STATE_DIR = os.environ.get('MESH_STATE_DIR', '.')  # Where the saved topology, routes and message log go
+event_loop = None  # The node's asyncio loop when RUNTIME is 'asyncio'
+client = None  # Created by start_node
 NEIGHBORS = set()
 latencies = defaultdict(dict)
+LINK_METRIC_SMOOTHING = 'ewma'  # How ping samples are combined into a link metric: 'ewma' or 'median'
+LATENCY_EWMA_ALPHA = 0.3  # Weight of the newest sample in the moving average
+LATENCY_MEDIAN_WINDOW = 5  # Number of recent samples the windowed median is taken over
+latency_samples = defaultdict(lambda: deque(maxlen=LATENCY_MEDIAN_WINDOW))
+# Compact binary control messages, used only towards nodes that announced them on capabilities/<node>
+BINARY_CODEC = 'b1'
+BINARY_MAGIC = b'\xb1'  # Never the first byte of a UTF-8 text payload
+BINARY_VERSION = 1
+KIND_CONNECTIONS, KIND_PING, KIND_PONG, KIND_NEXT_HOP, KIND_DATA, KIND_LINK, KIND_LINK_ACK = 1, 2, 3, 4, 5, 6, 7
+NODE_ID_SIZE = 8  # Node names are sent as fixed-width, NUL-padded fields
+BINARY_HEADER = struct.Struct(f"!cBB{NODE_ID_SIZE}s")  # magic, version, kind, sending/reporting node
+LINK_ENTRY = struct.Struct(f"!{NODE_ID_SIZE}sf")  # neighbor, float32 latency (NaN if not measured yet)
+TIMESTAMP_BODY = struct.Struct("!d")
+NEXT_HOP_BODY = struct.Struct("!QB")  # epoch, number of next hops following as node ids
+NODE_ID = struct.Struct(f"!{NODE_ID_SIZE}s")
+# Data frames carry one message or a batch, optionally compressed; source and destination stay
+# outside the compressed body so relays can route a frame without touching it
+DATA_HEADER = struct.Struct(f"!{NODE_ID_SIZE}sBQ")  # destination ('' = nearest gateway), flags, sequence
+DATA_FLAG_COMPRESSED, DATA_FLAG_DICTIONARY, DATA_FLAG_BATCH, DATA_FLAG_FRAGMENT = 1, 2, 4, 8
+FRAGMENT_HEADER = struct.Struct("!HH")  # fragment index, fragment count; follows DATA_HEADER
+# Largest data publish, matching TX_SIZE of the ESP mesh firmware; bigger frames are fragmented
+MESH_MTU = 1460
+REASSEMBLY_TIMEOUT = 10.0  # Seconds an incomplete message may wait for its missing fragments
+REASSEMBLY_MAX_MESSAGES = 32  # Incomplete messages buffered at once
+REASSEMBLY_MAX_BYTES = 8 * 1024 * 1024  # Fragment bytes buffered at once
+reassembly_buffers = OrderedDict()  # (source, seq) -> [{index: bytes}, fragment count, bytes, first seen]
+reassembly_bytes = 0
+COMPRESSION_CODEC = 'z1'
+COMPRESSION_THRESHOLD = 256  # Data bodies smaller than this many bytes are never compressed
+COMPRESSION_LEVEL = 6
+# Optional preset dictionary shared by all nodes (e.g. samples of typical telemetry payloads);
+# it is only used towards destinations that announced the same one
+COMPRESSION_DICTIONARY = b''
+COMPRESSION_DICTIONARY_ID = f"zd{zlib.adler32(COMPRESSION_DICTIONARY):08x}" if COMPRESSION_DICTIONARY else None
+peer_capabilities = {}  # Node -> codecs it announced on capabilities/<node>
+
+# Optional hop-by-hop reliability: data publishes to a next hop are wrapped in link frames with a
+# per-link sequence number, acknowledged cumulatively and retransmitted while at most LINK_WINDOW
+# of them are in flight. Every node accepts link frames ('r1'); RELIABLE_LINKS turns sending on.
+RELIABLE_LINKS = False
+LINK_CODEC = 'r1'
+LINK_HEADER = struct.Struct("!QQ")  # sequence number, oldest unacknowledged sequence number (window base)
+LINK_ACK = struct.Struct("!Q")  # highest sequence number received in order
+# Any hop may wrap a data frame in a link frame, so data frames leave room for the link header
+LINK_OVERHEAD = BINARY_HEADER.size + LINK_HEADER.size
+LINK_WINDOW = 32  # Frames in flight per next hop
+LINK_BACKLOG = 1024  # Frames waiting for the window per next hop; the oldest are dropped beyond this
+LINK_RTO_FACTOR = 2.0  # Retransmission timeout as a multiple of the measured round trip time
+LINK_MIN_RTO = 0.2  # Seconds, so very short round trips do not cause needless retransmissions
+LINK_DEFAULT_RTT = 0.5  # Seconds, for links without a latency measurement yet
+LINK_MAX_RETRIES = 5  # Then the link is given up and its frames are routed again
+LINK_TICK = 0.05  # Seconds between retransmission checks
+link_senders = {}  # Next hop -> LinkSender
+parked_frames = deque()  # (payload, source, destination) of given-up links with no other route yet
+link_receivers = {}  # Previous hop -> [next expected sequence number, {sequence number: payload}]
+link_lock = threading.RLock()
+
+# Every payload is decoded once into one of these before it reaches its handler
+# Data payloads are not copied or decoded while parsing: body is a memoryview into the raw payload,
+# which a relay publishes again as it is
+DataMessage = namedtuple('DataMessage', 'source seq destination body payload')  # seq is None from older nodes
+LinkFrame = namedtuple('LinkFrame', 'sender seq base payload')  # payload is the wrapped data message
+LinkAck = namedtuple('LinkAck', 'sender seq')
+# frame is the raw payload; fragment and fragments are None unless the frame is one fragment of a message
+DataFrame = namedtuple('DataFrame', 'source seq destination flags fragment fragments body frame')
+ConnectionsReport = namedtuple('ConnectionsReport', 'node links')
+Probe = namedtuple('Probe', 'sender timestamp')  # ping or pong
+NextHopUpdate = namedtuple('NextHopUpdate', 'epoch hops')  # epoch is None for unversioned updates
+RoutingTableUpdate = namedtuple('RoutingTableUpdate', 'epoch default table')
 MAX_CONNECTIONS = 2  # Maximum number of connections per node
 connection_slots = defaultdict(lambda: MAX_CONNECTIONS)  # Track available connection slots for each node
 accepted_connections = defaultdict(set)  # Track accepted connections for each node
 connections_list = defaultdict(list)  # List to store connections for each node
 next_hop = None
-
-
-# Define a global layout for node positions
+next_hops = []  # All equal-cost next hops towards the gateway; next_hop is the primary one
+next_hop_epoch = 0  # Epoch of the routing table our next_hop came from; older updates are dropped
+routing_table = {}  # Destination node -> next hop, for traffic that is not headed to the gateway
+routing_table_default = ''  # Next hop for destinations missing from routing_table ('' drops them)
+routing_table_epoch = 0
+# Fast start: restore the saved topology and routes, probe the last known neighbors and ask the
+# gateway for our route as soon as the broker connection is up instead of waiting for the timers
+FAST_START = True
+# The topology is persisted as a snapshot (CONNECTIONS_FILE, replaced atomically) plus a journal of
+# the link changes since, appended on every save; recovery replays the journal onto the snapshot.
+# Both carry the snapshot's generation, so a journal is only replayed onto the snapshot it follows.
+# A new snapshot is taken once the journal holds TOPOLOGY_SNAPSHOT_RECORDS records or is older
+# than TOPOLOGY_SNAPSHOT_INTERVAL seconds.
+CONNECTIONS_FILE = os.path.join(STATE_DIR, 'connections_list.json')
+TOPOLOGY_JOURNAL_FILE = os.path.join(STATE_DIR, 'connections_journal.jsonl')
+TOPOLOGY_SNAPSHOT_RECORDS = 1000
+TOPOLOGY_SNAPSHOT_INTERVAL = 300.0
+topology_journal = []  # Records not yet appended: ('set', node, neighbor, latency), ('remove', node, neighbor),
+#                        ('drop', node) or ('clear',)
+journal_records = 0  # Records in the journal file
+journal_generation = 0  # Generation of the last snapshot, clock-seeded so it keeps increasing across restarts
+journal_started = 0.0  # time.monotonic() of the last snapshot
+journaling = True  # Off while the saved topology is being restored
+journal_lock = threading.Lock()
+ROUTE_STATE_FILE = os.path.join(STATE_DIR, 'route_state.json')
+# Received messages are collected in memory and appended by a background flush every
+# MESSAGE_LOG_FLUSH_INTERVAL seconds, or sooner once MESSAGE_LOG_FLUSH_BYTES are waiting, so a crash
+# loses at most one interval. 'binary' writes compact records; read them with read_message_log.py.
+MESSAGE_LOG_FORMAT = 'text'  # 'text' or 'binary'
+RECEIVED_MESSAGES_FILE = os.path.join(STATE_DIR, 'received_messages.log' if MESSAGE_LOG_FORMAT == 'text'
+                                      else 'received_messages.bin')
+MESSAGE_LOG_FLUSH_INTERVAL = 1.0  # Seconds
+MESSAGE_LOG_FLUSH_BYTES = 64 * 1024
+MESSAGE_LOG_MAX_BYTES = 16 * 1024 * 1024  # The log is rotated to .1, .2, ... before it grows past this
+MESSAGE_LOG_BACKUPS = 3
+MESSAGE_LOG_MAGIC = b'\xb1MLOG1'  # Starts every binary log file
+MESSAGE_RECORD = struct.Struct("!dI")  # Receive time, text length; the UTF-8 text follows
+message_log_buffer = []  # Encoded records waiting for the next flush
+message_log_pending = 0  # Bytes in message_log_buffer
+message_log_flush_scheduled = False
+message_log_lock = threading.Lock()  # Guards the buffer
+message_log_write_lock = threading.Lock()  # Serializes flushes so records stay in order
+cached_neighbors = []  # Neighbors from the saved topology, probed right after connecting
+
+
+# Long-lived topology index shared by the connection handlers and the path algorithms.
+# Every node name gets a small integer id once and its links live in one dict keyed by
+# neighbor id, so connection reports are applied in place instead of rebuilding a graph.
+class TopologyIndex:
+    def __init__(self):
+        self.node_ids = {}  # Node name -> integer id
+        self.node_names = []  # Integer id -> node name
+        self.adjacency = []  # Integer id -> {neighbor id: latency}, kept symmetric
+        self.version = 0  # Bumped on every change so readers can tell a snapshot is stale
+
+    def node_id(self, name):
+        node_id = self.node_ids.get(name)
+        if node_id is None:
+            node_id = len(self.node_names)
+            self.node_ids[name] = node_id
+            self.node_names.append(name)
+            self.adjacency.append({})
+        return node_id
+
+    def neighbors(self, node_id):
+        return self.adjacency[node_id]
+
+    # Returns the previous weight of the link, or None if it is new
+    def set_link(self, u, v, weight):
+        old_weight = self.adjacency[u].get(v)
+        if old_weight != weight:
+            self.adjacency[u][v] = weight
+            self.adjacency[v][u] = weight
+            self.version += 1
+        return old_weight
+
+    def remove_link(self, u, v):
+        if v not in self.adjacency[u]:
+            return False
+        del self.adjacency[u][v]
+        del self.adjacency[v][u]
+        self.version += 1
+        return True
+
+    def clear(self):
+        for links in self.adjacency:
+            links.clear()
+        self.version += 1
+
+    def snapshot(self):
+        return TopologySnapshot(self)
+
+
+# Read-only view of the topology index for the path algorithms. Creating one is O(1);
+# it reflects the index at `version` and should not be held across further updates.
+class TopologySnapshot:
+    def __init__(self, index):
+        self.version = index.version
+        self.node_ids = MappingProxyType(index.node_ids)
+        self._node_names = index.node_names
+        self._adjacency = index.adjacency
+
+    def __len__(self):
+        return len(self._node_names)
+
+    def name(self, node_id):
+        return self._node_names[node_id]
+
+    def neighbors(self, node_id):
+        return MappingProxyType(self._adjacency[node_id])
+
+    def nodes(self):
+        return [node_id for node_id, links in enumerate(self._adjacency) if links]
+
+    def edges(self):
+        for u, links in enumerate(self._adjacency):
+            for v, weight in links.items():
+                if u < v:
+                    yield u, v, weight
+
+    # networkx graph with node names, only built when the network is displayed
+    def to_graph(self):
+        G = nx.Graph()
+        for u, v, weight in self.edges():
+            G.add_edge(self._node_names[u], self._node_names[v], weight=weight, label=f"{weight:.4f}")
+        return G
+
+
+topology = TopologyIndex()
+GATEWAY_IDS = {topology.node_id(gateway) for gateway in GATEWAY_NODES}
+departed_gateways = set()  # Gateways that announced their departure and are not routed to
+
+# Routing engine state: one reverse shortest-path forest rooted at every live gateway, keyed by
+# node id. Each node hangs below its nearest gateway, so this is a multi-source shortest path.
+route_distance = {gateway_id: 0.0 for gateway_id in GATEWAY_IDS}  # Path cost to the nearest gateway
+route_parent = {}  # Next hop towards the gateway for each reachable node
+route_children = defaultdict(set)  # Reverse of route_parent, used to walk affected subtrees
+pending_route_updates = set()  # Nodes whose place in the tree was touched since the last broadcast
+published_next_hops = {}  # Next hops last sent to each node, so unchanged routes are not re-sent
+published_routing_tables = {}  # Any-to-any forwarding table last sent to each node
+routing_tables_version = -1  # Topology version the published forwarding tables were computed from
+# The any-to-any tables cost one Dijkstra per node, so they are recomputed at most this often in
+# seconds; changes in between are picked up by one deferred run. Gateway next hops are not limited.
+ROUTING_TABLE_MIN_INTERVAL = 5.0
+routing_tables_computed = 0.0  # When the forwarding tables were last computed
+routing_tables_timer = None  # Deferred recompute for changes made within the interval
+route_controller_active = False  # Whether this gateway is the one currently publishing routes
+
+# Equal-cost multipath: neighbors that are strictly closer to the gateway and whose path cost is
+# within ECMP_TOLERANCE (relative) of the best one are published as extra next hops
+ECMP_TOLERANCE = 0.1
+ECMP_MAX_PATHS = 4
+# A node only moves to a different path when it is at least this fraction cheaper than its current one
+ROUTE_SWITCH_MARGIN = 0.1
+# Versions the distributed routing table; seeded from the clock so it keeps increasing across restarts
+routing_epoch = int(time.time() * 1000)
+routing_lock = threading.RLock()  # Guards the topology and routes shared with the recompute timer
+
+# Bursts of connection reports (e.g. after a reset) are coalesced into one recompute and persist
+RECOMPUTE_QUIET_WINDOW = 0.5  # Seconds without new topology changes before routes are broadcast
+RECOMPUTE_MAX_DELAY = 3.0  # Upper bound in seconds on how long a topology change may stay unpublished
+recompute_timer = None
+recompute_deadline = 0.0
+recompute_generation = 0  # Bumped on every schedule so a superseded timer that already fired does nothing
+recompute_lock = threading.Lock()
+
+# Optional Nagle-style batching: data messages of the same flow (source and destination) headed to
+# the same next hop are sent as one framed batch once it is full or its time budget has run out
+MESSAGE_BATCHING = False
+BATCH_MAX_BYTES = 1024  # Flush once the batched message text reaches this size
+BATCH_MAX_DELAY = 0.05  # Seconds the first message of a batch may wait for company
+pending_batches = {}  # (next hop, source, destination) -> [(seq, text) entries, size, flush timer]
+batch_lock = threading.Lock()
+
+# Data messages are identified by their origin and a per-origin sequence number, so copies that
+# come around again (e.g. through bridged brokers) are dropped instead of being relayed once more
+message_sequence = int(time.time() * 1000)  # Clock-seeded so ids are not reused after a restart
+DEDUP_CACHE_SIZE = 4096  # Message ids remembered at most
+DEDUP_TTL = 30.0  # Seconds a message id is remembered
+seen_messages = OrderedDict()  # (origin, seq) -> time first seen, oldest first
+duplicates_dropped = 0
+
+# Outbound traffic classes: every publish is queued by class and handed to the client by one sender
+# thread. Latency probes go first and other control traffic next, so neither waits behind bulk data;
+# data is shared between origins by deficit round robin, weighted by DATA_WEIGHTS.
+PROBE_TOPICS = ('ping', 'pong')
+DATA_TOPICS = ('message',)
+DATA_QUANTUM = MESH_MTU  # Bytes an origin of weight 1 may send per round
+DATA_WEIGHTS = {}  # Origin -> positive share of the data bandwidth (default 1)
+DATA_QUEUE_MAX_BYTES = 4 * 1024 * 1024  # Queued data beyond this is dropped
+outbound_control = (deque(), deque())  # (topic, payload, retain) for probes, then other control messages
+outbound_data = OrderedDict()  # Origin -> deque of (topic, payload), in round-robin order
+data_deficits = {}  # Origin -> bytes it may still send this round
+outbound_data_bytes = 0
+outbound_dropped = 0
+outbound_sending = False
+outbound_ready = threading.Condition()
+# The fragments of a large message are fed to the data queue (or the link to the next hop) as it
+# drains, so none of them is dropped at the queue bound and the destination gets the whole message.
+# They may fill the data queue up to FRAGMENT_QUEUE_BYTES, which leaves room for other traffic, and
+# are paced to FRAGMENT_STREAM_RATE: relays pass fragments on as they come, so a message handed
+# over all at once would overrun their queues instead.
+FRAGMENT_QUEUE_BYTES = DATA_QUEUE_MAX_BYTES // 2
+FRAGMENT_STREAM_RATE = 1024 * 1024  # Bytes per second, for all fragmented messages together
+FRAGMENT_STREAM_BURST = 256 * 1024  # Bytes that may go out at once after a pause
+fragment_streams = deque()  # [next hop, source, destination, deque of the frames still to send]
+stream_budget = FRAGMENT_STREAM_BURST  # Bytes that may be sent right now
+stream_refilled = 0.0  # time.monotonic() when stream_budget was last topped up
+stream_timer = None  # Resumes the streams once the budget allows the next fragment
+stream_lock = threading.Lock()  # Taken before link_lock and outbound_ready, never while holding them
+
+
+# Define a global layout for node positions; only needed when the graph is displayed
 def get_fixed_layout(G):
     return nx.spring_layout(G, seed=42)  # Use a seed for reproducible positions
 
 
+# Topic dispatch: handlers are looked up by the first topic level and called as handle(target, message),
+# where target is the rest of the topic and message the payload decoded by the registered parser.
+# The network thread only parses; handlers run on worker threads fed by a bounded queue, except the
+# inline ones, which are cheap and must not wait behind other work (latency probes).
+message_handlers = {}  # Topic prefix -> (parse, handle, own_topic, inline)
+handler_stats = defaultdict(lambda: [0, 0.0])  # Topic prefix -> [messages handled, seconds spent]
+# 1 or 0 only: the handlers update the neighbor, connection and routing state without locks of their
+# own, so they must not run concurrently, and a single worker also keeps messages in arrival order.
+# 0 runs every handler on the network thread (as does the asyncio runtime, which has no threads).
+WORKER_THREADS = 1
+WORK_QUEUE_SIZE = 1024
+WORK_QUEUE_POLICY = 'drop'  # When the queue is full: 'drop' the message or 'block' the network thread
+# The drop policy only applies to these. Control messages such as next hops, routing tables and
+# disconnects are sent once, not repeated, so they always wait for room instead.
+WORK_DROPPABLE = ('message', 'latency sample')
+work_queue = queue.Queue(WORK_QUEUE_SIZE)  # (label, function, args, time queued)
+work_dropped = 0
+work_blocked = 0  # Messages the network thread had to wait for room for
+work_high_water = 0  # Deepest the queue has been
+work_wait = [0, 0.0]  # [items handled by workers, seconds spent queued]
+
+
+def message_handler(prefix, parse, own_topic=True, inline=False):
+    def register(handle):
+        message_handlers[prefix] = (parse, handle, own_topic, inline)
+        return handle
+    return register
+
+
+def run_handler(label, function, args):
+    started = time.perf_counter()
+    try:
+        function(*args)
+    except Exception as e:  # A failing handler must not take the worker (or the network thread) down
+        print(f"Error handling {label} message: {e!r}")
+    stats = handler_stats[label]
+    stats[0] += 1
+    stats[1] += time.perf_counter() - started
+
+
+# Hand work to the workers according to WORK_QUEUE_POLICY, or run it right away without them
+def submit_work(label, function, *args):
+    global work_dropped, work_blocked, work_high_water
+    if WORKER_THREADS <= 0 or event_loop is not None:
+        run_handler(label, function, args)
+        return
+    item = (label, function, args, time.perf_counter())
+    try:
+        work_queue.put_nowait(item)
+    except queue.Full:
+        if WORK_QUEUE_POLICY != 'block' and label in WORK_DROPPABLE:
+            work_dropped += 1
+            print(f"Work queue is full, dropping {label} message")
+            return
+        work_blocked += 1
+        work_queue.put(item)
+    work_high_water = max(work_high_water, work_queue.qsize())
+
+
+def process_work():
+    while True:
+        label, function, args, queued = work_queue.get()
+        work_wait[0] += 1
+        work_wait[1] += time.perf_counter() - queued
+        run_handler(label, function, args)
+
+
+def print_handler_stats():
+    for prefix, (count, seconds) in sorted(handler_stats.items()):
+        print(f"  {prefix}: {count} messages, {seconds * 1000:.1f} ms total, {seconds / count * 1e6:.0f} us each")
+    mean_wait = work_wait[1] / work_wait[0] * 1000 if work_wait[0] else 0.0
+    print(f"Work queue: {work_queue.qsize()}/{WORK_QUEUE_SIZE} queued, {work_high_water} at most, "
+          f"{work_dropped} dropped, {work_blocked} blocked, {mean_wait:.2f} ms mean wait")
+
+
+# Queue a message for the sender thread. The payload may be a callable that builds it, which is
+# then called right before it goes out (probes carry their send time this way).
+def publish(topic, payload, retain=False, flow=None):
+    global outbound_data_bytes, outbound_dropped, outbound_sending
+    prefix = topic.partition('/')[0]
+    with outbound_ready:
+        if prefix in DATA_TOPICS:
+            if outbound_data_bytes + len(payload) > DATA_QUEUE_MAX_BYTES:
+                outbound_dropped += 1
+                print(f"Outbound data queue is full, dropping message to {topic}")
+                return
+            outbound_data.setdefault(flow, deque()).append((topic, payload))
+            outbound_data_bytes += len(payload)
+        else:
+            outbound_control[prefix not in PROBE_TOPICS].append((topic, payload, retain))
+        if event_loop is None:
+            outbound_ready.notify_all()
+        elif not outbound_sending:
+            outbound_sending = True
+            event_loop.call_soon(drain_outbound)
+
+
+# Pick the next message to send; called with outbound_ready held
+def next_outbound():
+    global outbound_data_bytes
+    for pending in outbound_control:
+        if pending:
+            return pending.popleft()
+    while outbound_data:
+        flow, pending = next(iter(outbound_data.items()))
+        topic, payload = pending[0]
+        deficit = data_deficits.get(flow, 0)
+        if deficit < len(payload):
+            # This origin used up its share for the round; top it up and move on to the next one
+            data_deficits[flow] = deficit + DATA_QUANTUM * DATA_WEIGHTS.get(flow, 1)
+            outbound_data.move_to_end(flow)
+            continue
+        data_deficits[flow] = deficit - len(payload)
+        pending.popleft()
+        outbound_data_bytes -= len(payload)
+        if not pending:
+            del outbound_data[flow]
+            del data_deficits[flow]  # An idle origin does not save up credit
+        return topic, payload, False
+    return None
+
+
+def send_outbound():
+    global outbound_sending
+    while True:
+        with outbound_ready:
+            message = next_outbound()
+            while message is None:
+                outbound_sending = False
+                outbound_ready.notify_all()
+                outbound_ready.wait()
+                message = next_outbound()
+            outbound_sending = True
+        publish_now(*message)
+        if fragment_streams:
+            feed_fragment_streams()
+
+
+# Payloads built when dequeued (pings) can still fail to encode; such a message is lost, not the sender
+def publish_now(topic, payload, retain):
+    try:
+        client.publish(topic, payload() if callable(payload) else payload, retain=retain)
+    except Exception as e:
+        print(f"Error publishing to {topic}: {e!r}")
+
+
+# The asyncio counterpart of send_outbound, scheduled on the loop by publish
+def drain_outbound():
+    global outbound_sending
+    with outbound_ready:
+        message = next_outbound()
+        while message is not None:
+            publish_now(*message)
+            message = next_outbound()
+        outbound_sending = False
+    if fragment_streams:
+        feed_fragment_streams()
+
+
+# Wait until everything queued so far has been handed to the client
+def flush_outbound(timeout=2.0):
+    if event_loop is not None:
+        drain_outbound()
+        return True
+    with outbound_ready:
+        return outbound_ready.wait_for(
+            lambda: not (outbound_sending or outbound_data or any(outbound_control)), timeout)
+
+
+# Run once after delay seconds, on the event loop or on a timer thread; the result can be cancelled
+def schedule_later(delay, callback, *args):
+    if event_loop is not None:
+        return event_loop.call_later(delay, callback, *args)
+    timer = threading.Timer(delay, callback, args)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+# Periodic tasks are generators that yield the seconds to wait before their next step,
+# so the same task can be driven by a thread or by the event loop
+def run_periodic(task):
+    if event_loop is not None:
+        event_loop.create_task(drive_periodic_async(task()))
+    else:
+        thread = threading.Thread(target=drive_periodic, args=(task(),))
+        thread.daemon = True
+        thread.start()
+
+
+def drive_periodic(steps):
+    for delay in steps:
+        time.sleep(delay)
+
+
+async def drive_periodic_async(steps):
+    for delay in steps:
+        await asyncio.sleep(delay)
+
+
 # Periodically broadcast presence for neighbor discovery
 def broadcast_presence():
     while True:
         if connection_slots[NODE_NAME] > 0:
-            client.publish(DISCOVERY_TOPIC, NODE_NAME)
+            publish(DISCOVERY_TOPIC, NODE_NAME)
             print(f"Broadcasting presence: {NODE_NAME}")
-        time.sleep(10)  # Broadcast every 10 seconds
+        yield 10  # Broadcast every 10 seconds
 
 
 def load_connections_from_json(file_path):
@@ -65,29 +562,33 @@ def display_network_graph(G, pos, shortest_path_edges=None):
 # Periodically broadcast connections
 def broadcast_connections_periodically():
     while True:
-        time.sleep(6)  # Wait before broadcasting connections
+        yield 6  # Wait before broadcasting connections
 
-        # Ensure that latency measurements are completed
+        # Re-probe established links so their metrics keep tracking current conditions
+        for neighbor in list(accepted_connections[NODE_NAME]):
+            measure_latency(neighbor)
 
-        time.sleep(5)  # Additional wait to ensure latencies are updated
+        yield 5  # Additional wait to ensure latencies are updated
 
         # Check if there are connections to broadcast
         if accepted_connections[NODE_NAME]:
-            # Construct connection info with latency
-            connections_info = [f"{node}:{latencies[NODE_NAME].get(node, 'N/A')}" for node in
-                                accepted_connections[NODE_NAME]]
-            client.publish(f"connections/{GATEWAY_NODE}", f"{NODE_NAME}:{','.join(connections_info)}")
+            publish_connections(GATEWAY_NODE)
         # print(f"Broadcasting connections with latency for node {NODE_NAME}")
         else:
             print(f"No connections to broadcast for node {NODE_NAME}")
 
         # Wait for additional time to allow all nodes to process the broadcast
-        time.sleep(5)
+        yield 5
 
 
 # Function to add a connection to the local connections list
+# connections_list and the accepted connections are only changed under routing_lock, which the
+# recompute timer holds while it persists them
 def add_local_connection(neighbor, latency):
-    if neighbor not in accepted_connections[NODE_NAME]:
+    with routing_lock:
+        if neighbor in accepted_connections[NODE_NAME]:
+            print(f"Connection with {neighbor} already exists")
+            return
         accepted_connections[NODE_NAME].add(neighbor)
         accepted_connections[neighbor].add(NODE_NAME)
         latencies[NODE_NAME][neighbor] = latency
@@ -98,9 +599,30 @@ def add_local_connection(neighbor, latency):
             connections_list[neighbor] = []
         connections_list[NODE_NAME].append((neighbor, latency))
         connections_list[neighbor].append((NODE_NAME, latency))
-        print(f"Added connection with {neighbor} with latency {latency}")
-    else:
-        print(f"Connection with {neighbor} already exists")
+        journal_link(NODE_NAME, neighbor, latency)
+        update_route_link(topology.node_id(NODE_NAME), topology.node_id(neighbor), latency)
+    print(f"Added connection with {neighbor} with latency {latency}")
+
+
+# Fold a new ping sample into the smoothed metric of the link to neighbor
+def smooth_latency(neighbor, sample):
+    if LINK_METRIC_SMOOTHING == 'median':
+        latency_samples[neighbor].append(sample)
+        return statistics.median(latency_samples[neighbor])
+    previous = latencies[NODE_NAME].get(neighbor)
+    if previous is None:
+        return sample
+    return previous + LATENCY_EWMA_ALPHA * (sample - previous)
+
+
+# Re-weight an established link after its smoothed latency changed
+def update_local_latency(neighbor, latency):
+    with routing_lock:
+        connections_list[NODE_NAME] = [(n, latency if n == neighbor else l) for n, l in connections_list[NODE_NAME]]
+        connections_list[neighbor] = [(n, latency if n == NODE_NAME else l) for n, l in connections_list[neighbor]]
+        journal_link(NODE_NAME, neighbor, latency)
+        update_route_link(topology.node_id(NODE_NAME), topology.node_id(neighbor), latency)
+    schedule_route_recompute()
 
 
 # Function to handle new connections and update lists
@@ -112,9 +634,10 @@ def handle_new_connection(neighbor, latency):
             connection_slots[NODE_NAME] -= 1
             add_local_connection(neighbor, latency)
             # Request connection list from newly connected node
-            client.publish(f"connections_request/{neighbor}", NODE_NAME)
-            client.publish(f"connections/{NODE_NAME}",
-                           f"{NODE_NAME}:{','.join([f'{n}:{latencies[NODE_NAME].get(n, 'N/A')}' for n in accepted_connections[NODE_NAME]])}")
+            publish(f"connections_request/{neighbor}", NODE_NAME)
+            publish_connections(NODE_NAME)
+            if FAST_START:
+                publish_connections(GATEWAY_NODE)  # Don't wait for the periodic report
         else:
             print(f"Neighbor {neighbor} has reached its connection limit.")
     else:
@@ -123,30 +646,240 @@ def handle_new_connection(neighbor, latency):
 
 # Function to broadcast a reset command to all nodes
 def broadcast_reset():
-    client.publish('reset', 'RESET_COMMAND')
+    publish('reset', 'RESET_COMMAND')
     print("Broadcasting reset command to all nodes")
 
 
 # Measure latency to a neighbor
 def measure_latency(neighbor):
-    start_time = time.time()
-    client.publish(f"ping/{neighbor}", f"{NODE_NAME}:{start_time}")
+    # Timestamped when the sender thread takes the ping, so our own queue is not part of the sample
+    if speaks_binary([neighbor]):
+        publish(f"ping/{neighbor}", lambda: encode_binary(KIND_PING, NODE_NAME, TIMESTAMP_BODY.pack(time.time())))
+    else:
+        publish(f"ping/{neighbor}", lambda: f"{NODE_NAME}:{time.time()}")
     print(f"Measuring latency to {neighbor}.")
-    return start_time
+
+
+# Whether every receiver of a message announced the given codec. All codecs are binary framed,
+# so none of them is used while our own name does not fit the binary node id.
+def peers_support(receivers, codec):
+    return fits_node_id(NODE_NAME) and all(node == NODE_NAME or codec in peer_capabilities.get(node, ())
+                                           for node in receivers)
+
+
+# names are the node names the binary message would carry; a message with a name that does not
+# fit has to go as text
+def speaks_binary(receivers, names=()):
+    return peers_support(receivers, BINARY_CODEC) and all(fits_node_id(name) for name in names)
+
+
+def fits_node_id(name):
+    return len(name.encode()) <= NODE_ID_SIZE
+
+
+def node_id_bytes(name):
+    raw = name.encode()
+    if len(raw) > NODE_ID_SIZE:
+        raise ValueError(f"Node name {name} does not fit the {NODE_ID_SIZE} byte binary node id")
+    return raw
+
+
+def encode_binary(kind, node, body=b''):
+    return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, kind, node_id_bytes(node)) + body
+
+
+def encode_connections(node, links):
+    body = [struct.pack('!H', len(links))]
+    for neighbor, latency in links:
+        body.append(LINK_ENTRY.pack(node_id_bytes(neighbor), math.nan if latency is None else latency))
+    return encode_binary(KIND_CONNECTIONS, node, b''.join(body))
+
+
+def encode_next_hop(epoch, hops):
+    body = NEXT_HOP_BODY.pack(epoch, len(hops)) + b''.join(NODE_ID.pack(node_id_bytes(hop)) for hop in hops)
+    return encode_binary(KIND_NEXT_HOP, NODE_NAME, body)
+
+
+# Binary data frames for (seq, text) entries of one flow, compressed when the body is large enough
+# and the final receiver can decompress it, and split into fragments when they would not fit MESH_MTU
+# inside a link frame.
+# Returns None for a single message that fits as it is. Frames carry the sequence number of their
+# first entry as their id.
+def encode_data_frames(source, destination, entries):
+    flags = 0
+    if len(entries) == 1:
+        body = entries[0][1].encode()
+    else:
+        flags |= DATA_FLAG_BATCH
+        body = [struct.pack('!H', len(entries))]
+        for seq, text in entries:
+            raw = text.encode()
+            body.append(struct.pack('!QH', seq or 0, len(raw)) + raw)
+        body = b''.join(body)
+    receivers = GATEWAY_NODES if destination is None else [destination]
+    if len(body) >= COMPRESSION_THRESHOLD and peers_support(receivers, COMPRESSION_CODEC):
+        if COMPRESSION_DICTIONARY_ID and peers_support(receivers, COMPRESSION_DICTIONARY_ID):
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=COMPRESSION_DICTIONARY)
+            compressed_flags = DATA_FLAG_COMPRESSED | DATA_FLAG_DICTIONARY
+        else:
+            compressor = zlib.compressobj(COMPRESSION_LEVEL)
+            compressed_flags = DATA_FLAG_COMPRESSED
+        compressed = compressor.compress(body) + compressor.flush()
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= compressed_flags
+    seq = entries[0][0]
+    destination_id = node_id_bytes(destination or '')
+    if LINK_OVERHEAD + BINARY_HEADER.size + DATA_HEADER.size + len(body) <= MESH_MTU or seq is None:
+        if flags == 0:
+            return None
+        return [encode_binary(KIND_DATA, source, DATA_HEADER.pack(destination_id, flags, seq or 0) + body)]
+    header = DATA_HEADER.pack(destination_id, flags | DATA_FLAG_FRAGMENT, seq)
+    chunk = MESH_MTU - LINK_OVERHEAD - BINARY_HEADER.size - DATA_HEADER.size - FRAGMENT_HEADER.size
+    count = -(-len(body) // chunk)
+    if count > 0xffff:
+        raise ValueError(f"Message of {len(body)} bytes needs more than {0xffff} fragments")
+    body = memoryview(body)
+    return [encode_binary(KIND_DATA, source, header + FRAGMENT_HEADER.pack(index, count) + body[index * chunk:(index + 1) * chunk])
+            for index in range(count)]
+
+
+# Collect the fragments of a message; returns its body once the last one arrived, else None.
+# Buffers are bounded in number, bytes and age, the oldest incomplete message is dropped first.
+def reassemble(frame):
+    global reassembly_bytes
+    now = time.monotonic()
+    for key, buffer in list(reassembly_buffers.items()):
+        if now - buffer[3] < REASSEMBLY_TIMEOUT:
+            break
+        drop_reassembly(key, 'timed out')
+    key = (frame.source, frame.seq)
+    if key not in reassembly_buffers:
+        if len(reassembly_buffers) >= REASSEMBLY_MAX_MESSAGES:
+            drop_reassembly(next(iter(reassembly_buffers)), 'too many incomplete messages')
+        reassembly_buffers[key] = [{}, frame.fragments, 0, now]
+    body = bytes(frame.body)
+    while reassembly_bytes + len(body) > REASSEMBLY_MAX_BYTES:
+        oldest = next(iter(reassembly_buffers))
+        drop_reassembly(oldest, 'out of reassembly space')
+        if oldest == key:
+            return None
+    buffer = reassembly_buffers[key]
+    if frame.fragment in buffer[0] or frame.fragment >= buffer[1]:
+        return None
+    buffer[0][frame.fragment] = body
+    buffer[2] += len(body)
+    reassembly_bytes += len(body)
+    if len(buffer[0]) < buffer[1]:
+        return None
+    del reassembly_buffers[key]
+    reassembly_bytes -= buffer[2]
+    return b''.join(buffer[0][index] for index in range(buffer[1]))
+
+
+def drop_reassembly(key, reason):
+    global reassembly_bytes
+    buffer = reassembly_buffers.pop(key)
+    reassembly_bytes -= buffer[2]
+    print(f"Dropping incomplete message {key[1]} from {key[0]}: {reason} ({len(buffer[0])}/{buffer[1]} fragments)")
+
+
+# The (seq, text) entries of a data frame; only the final receiver does this, relays forward the
+# frame as it is
+def unpack_data_frame(frame):
+    body = frame.body
+    if frame.flags & DATA_FLAG_COMPRESSED:
+        if frame.flags & DATA_FLAG_DICTIONARY:
+            decompressor = zlib.decompressobj(zdict=COMPRESSION_DICTIONARY)
+        else:
+            decompressor = zlib.decompressobj()
+        body = decompressor.decompress(body) + decompressor.flush()
+    if not frame.flags & DATA_FLAG_BATCH:
+        return [(frame.seq, str(body, 'utf-8'))]
+    (count,) = struct.unpack_from('!H', body)
+    offset = 2
+    entries = []
+    for _ in range(count):
+        seq, length = struct.unpack_from('!QH', body, offset)
+        offset += 10
+        entries.append((seq or None, str(body[offset:offset + length], 'utf-8')))
+        offset += length
+    return entries
+
+
+# Publish this node's links to connections/<topic_node>, in binary when all its subscribers accept it
+def publish_connections(topic_node):
+    with routing_lock:
+        links = [(node, latencies[NODE_NAME].get(node)) for node in accepted_connections[NODE_NAME]]
+    receivers = GATEWAY_NODES if topic_node in GATEWAY_NODES else [topic_node]
+    if speaks_binary(receivers):
+        try:
+            publish(f"connections/{topic_node}", encode_connections(NODE_NAME, links))
+            return
+        except ValueError as e:
+            print(f"Sending connections as text: {e}")
+    connections_info = [f"{node}:{'N/A' if latency is None else latency}" for node, latency in links]
+    publish(f"connections/{topic_node}", f"{NODE_NAME}:{','.join(connections_info)}")
+
+
+# Turn a binary control message into the same typed message the text parsers produce
+def decode_binary(payload):
+    magic, version, kind, node = BINARY_HEADER.unpack_from(payload)
+    if version != BINARY_VERSION:
+        print(f"Ignoring binary message of unsupported version {version}")
+        return None
+    node = node.rstrip(b'\0').decode()
+    offset = BINARY_HEADER.size
+    if kind == KIND_CONNECTIONS:
+        (count,) = struct.unpack_from('!H', payload, offset)
+        offset += 2
+        links = [(neighbor.rstrip(b'\0').decode(), latency)
+                 for neighbor, latency in LINK_ENTRY.iter_unpack(payload[offset:offset + count * LINK_ENTRY.size])
+                 if not math.isnan(latency)]
+        return ConnectionsReport(node, links)
+    elif kind in (KIND_PING, KIND_PONG):
+        return Probe(node, TIMESTAMP_BODY.unpack_from(payload, offset)[0])
+    elif kind == KIND_NEXT_HOP:
+        epoch, count = NEXT_HOP_BODY.unpack_from(payload, offset)
+        offset += NEXT_HOP_BODY.size
+        hops = [hop.rstrip(b'\0').decode() for (hop,) in NODE_ID.iter_unpack(payload[offset:offset + count * NODE_ID.size])]
+        return NextHopUpdate(epoch, hops)
+    elif kind == KIND_DATA:
+        destination, flags, seq = DATA_HEADER.unpack_from(payload, offset)
+        offset += DATA_HEADER.size
+        fragment = fragments = None
+        if flags & DATA_FLAG_FRAGMENT:
+            fragment, fragments = FRAGMENT_HEADER.unpack_from(payload, offset)
+            offset += FRAGMENT_HEADER.size
+        body = memoryview(payload)[offset:]
+        return DataFrame(node, seq or None, destination.rstrip(b'\0').decode() or None, flags, fragment, fragments,
+                         body, payload)
+    elif kind == KIND_LINK:
+        seq, base = LINK_HEADER.unpack_from(payload, offset)
+        return LinkFrame(node, seq, base, memoryview(payload)[offset + LINK_HEADER.size:])
+    elif kind == KIND_LINK_ACK:
+        return LinkAck(node, LINK_ACK.unpack_from(payload, offset)[0])
+    print(f"Ignoring binary message of unknown kind {kind} from {node}")
+    return None
 
 
 def request_connection_acknowledgment(neighbor):
-    client.publish(f"ack_request/{neighbor}", NODE_NAME)
+    publish(f"ack_request/{neighbor}", NODE_NAME)
     print(f"Requested acknowledgment from {neighbor}")
 
 
-def handle_connection_acknowledgment(sender):
+def parse_node_name(payload):
+    return payload.decode()
+
+
+@message_handler('ack_request', parse_node_name)
+def handle_connection_acknowledgment(target, sender):
     if sender in NEIGHBORS:
         accepted_connections[NODE_NAME].add(sender)
         accepted_connections[sender].add(NODE_NAME)
         print(f"Connection with {sender} is now finalized")
         # Request connection list from newly connected node
-        client.publish(f"connections_request/{sender}", NODE_NAME)
+        publish(f"connections_request/{sender}", NODE_NAME)
     else:
         print(f"Unexpected acknowledgment from {sender}")
 
@@ -158,103 +891,320 @@ def handle_received_message(message):
     # Example: You might want to print the message, log it, or perform some action
     # For instance, you can add logic to process or forward the message further
     # You can also log it to a file or database if needed
-    with open('received_messages.log', 'a') as file:
-        file.write(f"{time.ctime()}: {message}\n")
+    log_received_message(message)
 
     # If needed, perform further processing of the message
     # e.g., updating a database, triggering an event, etc.
 
 
+def log_received_message(text):
+    global message_log_pending, message_log_flush_scheduled
+    received = time.time()
+    if MESSAGE_LOG_FORMAT == 'binary':
+        raw = text.encode()
+        record = MESSAGE_RECORD.pack(received, len(raw)) + raw
+    else:
+        record = f"{time.ctime(received)}: {text}\n".encode()
+    with message_log_lock:
+        message_log_buffer.append(record)
+        message_log_pending += len(record)
+        flush_now = message_log_pending >= MESSAGE_LOG_FLUSH_BYTES and not message_log_flush_scheduled
+        if flush_now:
+            message_log_flush_scheduled = True
+    if flush_now:
+        schedule_later(0, flush_message_log)
+
+
+def flush_message_log():
+    global message_log_buffer, message_log_pending, message_log_flush_scheduled
+    with message_log_write_lock:
+        with message_log_lock:
+            records, message_log_buffer = message_log_buffer, []
+            message_log_pending = 0
+            message_log_flush_scheduled = False
+        if not records:
+            return
+        data = b''.join(records)
+        try:
+            size = os.path.getsize(RECEIVED_MESSAGES_FILE)
+        except OSError:
+            size = 0
+        if size and size + len(data) > MESSAGE_LOG_MAX_BYTES:
+            rotate_message_log()
+            size = 0
+        with open(RECEIVED_MESSAGES_FILE, 'ab') as file:
+            if not size and MESSAGE_LOG_FORMAT == 'binary':
+                file.write(MESSAGE_LOG_MAGIC)
+            file.write(data)
+
+
+# received_messages.log -> .1 -> .2 ...; the oldest backup is dropped
+def rotate_message_log():
+    for index in range(MESSAGE_LOG_BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{RECEIVED_MESSAGES_FILE}.{index}"):
+            os.replace(f"{RECEIVED_MESSAGES_FILE}.{index}", f"{RECEIVED_MESSAGES_FILE}.{index + 1}")
+    if MESSAGE_LOG_BACKUPS > 0:
+        os.replace(RECEIVED_MESSAGES_FILE, f"{RECEIVED_MESSAGES_FILE}.1")
+    else:
+        os.remove(RECEIVED_MESSAGES_FILE)
+    print(f"Rotated {RECEIVED_MESSAGES_FILE}")
+
+
+def flush_message_log_periodically():
+    while True:
+        yield MESSAGE_LOG_FLUSH_INTERVAL
+        flush_message_log()
+
+
 # Callback when a message is received
 def on_message(client, userdata, msg):
-    global NEIGHBORS, latencies, connection_slots, accepted_connections, connections_list
-    topic_parts = msg.topic.split('/')
+    prefix, _, target = msg.topic.partition('/')
+    entry = message_handlers.get(prefix)
+    if entry is None:
+        return
+    parse, handle, own_topic, inline = entry
+    if own_topic and target != NODE_NAME:
+        return
+    try:
+        message = decode_binary(msg.payload) if msg.payload[:1] == BINARY_MAGIC else parse(msg.payload)
+    except (ValueError, struct.error, zlib.error) as e:
+        print(f"Ignoring malformed {prefix} message: {e}")
+        return
+    if message is None:
+        return
+    if inline:
+        run_handler(prefix, handle, (target, message))
+    else:
+        submit_work(prefix, handle, target, message)
 
-    payload = msg.payload.decode()
 
-    if topic_parts[0] == 'message':
-        source_node, actual_message = payload.split(':', 1)
-        if topic_parts[1] == GATEWAY_NODE:
-            print(f"Message received from {source_node}: {actual_message}")
-            handle_received_message(actual_message)
-        elif topic_parts[1] == NODE_NAME:
-            forward_message_to_next_hop(actual_message, source_node)
-        else:
-            return
+def parse_capabilities(payload):
+    return frozenset(payload.decode().split(','))
+
+
+@message_handler('capabilities', parse_capabilities, own_topic=False)
+def handle_capabilities(node, capabilities):
+    peer_capabilities[node] = capabilities
 
-    if topic_parts[0] == 'disconnect' and topic_parts[1] == 'all':
-        departed_node = payload
-        handle_node_departure(departed_node)
-
-    if topic_parts[0] == 'connections' and topic_parts[1] == GATEWAY_NODE:
-        node, connections_info = payload.split(':', 1)
-        connections_list[node] = []
-        for info in connections_info.split(','):
-            if ':' in info:
-                parts = info.split(':')
-                if len(parts) == 2:
-                    neighbor, latency = parts
-                    try:
-                        latency = float(latency)
-                        connections_list[node].append((neighbor, latency))
-                        latencies[node][neighbor] = latency
-                        latencies[neighbor][node] = latency
-                    except ValueError:
-                        print(f"Warning: Invalid latency value: {latency}")
-                else:
-                    print(f"Warning: Info string does not contain exactly two parts separated by ':': {info}")
+
+# Header is "source#seq>destination"; messages without a destination go to the nearest gateway.
+# Older nodes read "source#seq" as the source and pass it on unchanged. Only the header is decoded.
+def parse_data_message(payload):
+    end = payload.index(b':')
+    source, _, destination = payload[:end].decode().partition('>')
+    source, _, seq = source.partition('#')
+    return DataMessage(source, int(seq) if seq else None, destination or None, memoryview(payload)[end + 1:], payload)
+
+
+def next_message_sequence():
+    global message_sequence
+    message_sequence += 1
+    return message_sequence
+
+
+# Remember the id and report whether it was already seen; messages without an id are never duplicates.
+# Fragments of one message share its id and are told apart by their index.
+def is_duplicate(origin, seq, fragment=None):
+    global duplicates_dropped
+    if seq is None:
+        return False
+    now = time.monotonic()
+    while seen_messages:
+        oldest = next(iter(seen_messages.values()))
+        if now - oldest < DEDUP_TTL and len(seen_messages) < DEDUP_CACHE_SIZE:
+            break
+        seen_messages.popitem(last=False)
+    key = (origin, seq, fragment)
+    if key in seen_messages:
+        duplicates_dropped += 1
+        return True
+    seen_messages[key] = now
+    return False
+
+
+@message_handler('message', parse_data_message)
+def handle_data_message(target, message):
+    if isinstance(message, LinkFrame):
+        # Every payload is acknowledged already, so one bad payload must not cost the ones after it
+        for payload in receive_link_frame(message):
+            try:
+                inner = decode_binary(payload) if payload[:1] == BINARY_MAGIC else parse_data_message(payload)
+            except (ValueError, struct.error, zlib.error) as e:
+                print(f"Ignoring malformed payload of a link frame from {message.sender}: {e}")
+                continue
+            if inner is None:
+                continue
+            try:
+                handle_data_message(target, inner)
+            except Exception as e:
+                print(f"Error handling a payload of a link frame from {message.sender}: {e!r}")
+        return
+    fragment = message.fragment if isinstance(message, DataFrame) else None
+    if is_duplicate(message.source, message.seq, fragment):
+        print(f"Dropping duplicate message {message.seq} from {message.source}")
+        return
+    delivered = message.destination == NODE_NAME or (message.destination is None and NODE_NAME in GATEWAY_NODES)
+    if isinstance(message, DataFrame):
+        if not delivered:
+            forward_data_frame(message)
+            return
+        if fragment is not None:
+            body = reassemble(message)
+            if body is None:
+                return
+            message = message._replace(flags=message.flags & ~DATA_FLAG_FRAGMENT, fragment=None, fragments=None,
+                                        body=body)
+        try:
+            entries = unpack_data_frame(message)
+        except (ValueError, struct.error, zlib.error) as e:
+            print(f"Dropping undecodable data frame from {message.source}: {e}")
+            return
+        for index, (seq, text) in enumerate(entries):
+            # The first entry's id is the frame id checked above
+            if index and is_duplicate(message.source, seq):
+                continue
+            print(f"Message received from {message.source}: {text}")
+            handle_received_message(text)
+    elif delivered:
+        text = str(message.body, 'utf-8', 'replace')
+        print(f"Message received from {message.source}: {text}")
+        handle_received_message(text)
+    else:
+        relay_data_message(message)
+
+
+@message_handler('disconnect', parse_node_name, own_topic=False)
+def handle_disconnect(target, node):
+    if target == 'all':
+        handle_node_departure(node)
+    elif target == NODE_NAME and node in NEIGHBORS:
+        with routing_lock:
+            NEIGHBORS.remove(node)
+            connection_slots[node] += 1
+            accepted_connections[node].remove(NODE_NAME)
+        print(f"Disconnected from {node}")
+        publish_connections(NODE_NAME)
+        give_up_link(node)
+
+
+def parse_connections(payload):
+    node, connections_info = payload.decode().split(':', 1)
+    reported_connections = []
+    for info in connections_info.split(','):
+        if ':' in info:
+            parts = info.split(':')
+            if len(parts) == 2:
+                neighbor, latency = parts
+                try:
+                    reported_connections.append((neighbor, float(latency)))
+                except ValueError:
+                    print(f"Warning: Invalid latency value: {latency}")
             else:
-                print(f"Warning: Info string does not contain ':': {info}")
-        print(f"Received connections list with latency from {node}: {connections_list[node]}")
-        save_connections_to_file()
-        if NODE_NAME == GATEWAY_NODE:
-            calculate_and_broadcast_next_hops()
-            print('calculating hops')
+                print(f"Warning: Info string does not contain exactly two parts separated by ':': {info}")
+        else:
+            print(f"Warning: Info string does not contain ':': {info}")
+    return ConnectionsReport(node, reported_connections)
+
+
+# Only reports sent to a gateway's topic feed the topology
+@message_handler('connections', parse_connections, own_topic=False)
+def handle_connections_report(target, report):
+    if target not in GATEWAY_NODES:
+        return
+    for neighbor, latency in report.links:
+        latencies[report.node][neighbor] = latency
+        latencies[neighbor][report.node] = latency
+    apply_connections_report(report.node, report.links)
+    print(f"Received connections list with latency from {report.node}: {connections_list[report.node]}")
+    schedule_route_recompute()
+
+
+@message_handler(DISCOVERY_TOPIC, parse_node_name, own_topic=False)
+def handle_discovery(target, node):
+    if node != NODE_NAME and node not in accepted_connections[NODE_NAME]:
+        measure_latency(node)
+
+
+@message_handler('connections_request', parse_node_name)
+def handle_connections_request(target, requester):
+    if accepted_connections[NODE_NAME]:
+        publish_connections(NODE_NAME)
+        print(f"Broadcasting connections for {NODE_NAME}")
+    else:
+        print(f"No connections to broadcast for {NODE_NAME}")
+
+
+def parse_probe(payload):
+    sender, timestamp = payload.decode().split(':')[:2]
+    return Probe(sender, float(timestamp))
+
+
+@message_handler('ping', parse_probe, inline=True)
+def handle_ping(target, probe):
+    if speaks_binary([probe.sender]):
+        publish(f"pong/{probe.sender}", encode_binary(KIND_PONG, NODE_NAME, TIMESTAMP_BODY.pack(probe.timestamp)))
+    else:
+        publish(f"pong/{probe.sender}", f"{NODE_NAME}:{probe.timestamp}")
+    print(f"Responded to ping from {probe.sender}")
+
 
-    elif topic_parts[0] == 'ping' and topic_parts[1] == NODE_NAME:
-        client.publish(f"pong/{msg.payload.decode().split(':')[0]}",
-                       f"{NODE_NAME}:{msg.payload.decode().split(':')[1]}")
-        print(f"Responded to ping from {msg.payload.decode().split(':')[0]}")
-    elif topic_parts[0] == 'pong' and topic_parts[1] == NODE_NAME:
-        latency = time.time() - float(msg.payload.decode().split(":")[1])
-        sender = msg.payload.decode().split(":")[0]
-        latencies[NODE_NAME][sender] = latency
-        latencies[sender][NODE_NAME] = latency
-        print(f"Measured latency to {sender}: {latency:.4f} seconds")
+# The sample is taken on arrival; updating the link and the routes with it waits for a worker
+@message_handler('pong', parse_probe, inline=True)
+def handle_pong(target, probe):
+    submit_work('latency sample', apply_latency_sample, probe.sender, time.time() - probe.timestamp)
+
+
+def apply_latency_sample(sender, sample):
+    latency = smooth_latency(sender, sample)
+    latencies[NODE_NAME][sender] = latency
+    latencies[sender][NODE_NAME] = latency
+    print(f"Measured latency to {sender}: {sample:.4f} seconds (smoothed {latency:.4f})")
+    if sender in accepted_connections[NODE_NAME]:
+        update_local_latency(sender, latency)
+    else:
         handle_new_connection(sender, latency)
-    elif msg.topic == DISCOVERY_TOPIC and msg.payload.decode() != NODE_NAME:
-        new_neighbor = msg.payload.decode()
-        if new_neighbor not in accepted_connections[NODE_NAME]:
-            start_time = measure_latency(new_neighbor)
-
-    elif topic_parts[0] == 'disconnect' and topic_parts[1] == NODE_NAME:
-        disconnected_node = msg.payload.decode()
-        if disconnected_node in NEIGHBORS:
-            NEIGHBORS.remove(disconnected_node)
-            connection_slots[disconnected_node] += 1
-            accepted_connections[disconnected_node].remove(NODE_NAME)
-            print(f"Disconnected from {disconnected_node}")
-            client.publish(f"connections/{NODE_NAME}",
-                           f"{NODE_NAME}:{','.join([f'{n}:{latencies[NODE_NAME].get(n)}' for n in accepted_connections[NODE_NAME]])}")
-    elif topic_parts[0] == 'ack_request' and topic_parts[1] == NODE_NAME:
-        handle_connection_acknowledgment(msg.payload.decode())
-    elif topic_parts[0] == 'connections_request' and topic_parts[1] == NODE_NAME:
-        if accepted_connections[NODE_NAME]:
-            connections_info = [f"{node}:{latencies[NODE_NAME].get(node)}" for node in
-                                accepted_connections[NODE_NAME]]
-            client.publish(f"connections/{NODE_NAME}", f"{NODE_NAME}:{','.join(connections_info)}")
-            print(f"Broadcasting connections for {NODE_NAME}")
-        else:
-            print(f"No connections to broadcast for {NODE_NAME}")
 
-    elif topic_parts[0] == 'next_hop' and topic_parts[1] == NODE_NAME:
-        global next_hop
-        next_hop = payload
-        print(f"Received next hop information: {next_hop}")
+
+def parse_next_hop(payload):
+    payload = payload.decode()
+    if ':' in payload:
+        epoch, hops = payload.split(':', 1)
+        return NextHopUpdate(int(epoch), hops.split(','))
+    return NextHopUpdate(None, payload.split(','))  # Unversioned update from an older gateway
 
 
+@message_handler('next_hop', parse_next_hop)
+def handle_next_hop(target, update):
+    global next_hop, next_hops, next_hop_epoch
+    if update.epoch is not None:
+        if update.epoch <= next_hop_epoch:
+            print(f"Ignoring stale next hops {','.join(update.hops)} from epoch {update.epoch} (current epoch {next_hop_epoch})")
+            return
+        next_hop_epoch = update.epoch
+    next_hops = update.hops
+    next_hop = next_hops[0]
+    print(f"Received next hop information: {', '.join(next_hops)} (epoch {next_hop_epoch})")
+    save_route_state()
+    resend_parked_frames()
+
+
+# The gateway publishing routes answers a (re)started node with its current next hops and table
+@message_handler('route_request', parse_node_name)
+def handle_route_request(target, node):
+    with routing_lock:
+        if not is_route_controller() or node not in topology.node_ids:
+            return
+        hops = get_equal_cost_next_hops(topology.node_ids[node])
+        if hops:
+            send_next_hops(node, hops)
+            published_next_hops[node] = hops
+        table = published_routing_tables.get(node)
+        if table is not None:
+            publish(f"routes/{node}", encode_routing_table(routing_epoch, table))
+    print(f"Answered route request from {node}")
+
 def recompute_shortest_paths():
-    path, G, pos = find_shortest_path_to_gateway()
+    path = find_shortest_path_to_gateway()
     if path:
         print(f"Recomputed shortest path: {' -> '.join(path)}")
     else:
@@ -264,167 +1214,1114 @@ def recompute_shortest_paths():
 def handle_node_departure(departed_node):
     print(f"Handling departure of node: {departed_node}")
 
-    # Check if the departed node is in the connections list
-    if departed_node in connections_list:
-        print(f"Node {departed_node} found in connections list. Removing...")
-        # Remove the departed node from the connections list
-        del connections_list[departed_node]
-    else:
-        print(f"Node {departed_node} not found in connections list.")
-
-    # Iterate through all remaining nodes in the connections list
-    for node, connections in list(connections_list.items()):
-        # Update the connections for each node by removing any that involve the departed node
-        updated_connections = [conn for conn in connections if conn[0] != departed_node]
-        if len(updated_connections) != len(connections):
-            print(f"Updating connections for node {node}.")
-        connections_list[node] = updated_connections
+    with routing_lock:
+        # Check if the departed node is in the connections list
+        if departed_node in connections_list:
+            print(f"Node {departed_node} found in connections list. Removing...")
+            # Remove the departed node from the connections list
+            del connections_list[departed_node]
+            journal_record('drop', departed_node)
+        else:
+            print(f"Node {departed_node} not found in connections list.")
+
+        departed_id = topology.node_ids.get(departed_node)
+        if departed_id is not None:
+            # Only the departed node's neighbours in the topology index can still list it
+            for neighbor_id in list(topology.neighbors(departed_id)):
+                node = topology.node_names[neighbor_id]
+                connections = connections_list.get(node, [])
+                # Update the connections for each node by removing any that involve the departed node
+                updated_connections = [conn for conn in connections if conn[0] != departed_node]
+                if len(updated_connections) != len(connections):
+                    print(f"Updating connections for node {node}.")
+                    connections_list[node] = updated_connections
+                    journal_record('remove', node, departed_node)
+
+            # Detach the departed node from the shortest-path tree; only its subtree is repaired
+            remove_route_node(departed_id)
+        if departed_node in GATEWAY_NODES:
+            # Nodes below the departed gateway were re-attached to the remaining ones above
+            departed_gateways.add(departed_node)
+            route_distance.pop(topology.node_id(departed_node), None)
+        published_next_hops.pop(departed_node, None)
+        published_routing_tables.pop(departed_node, None)
+        latency_samples.pop(departed_node, None)
 
     # Log the update
     print(f"Updated connections list after {departed_node} departure: {connections_list}")
 
-    # Save the updated connections list to a file
-    save_connections_to_file()
-
     # Recompute the shortest paths based on the updated connections list
     recompute_shortest_paths()
 
+    # Save the updated connections list and broadcast next hops once the burst settles
+    schedule_route_recompute()
+
+    # Frames still waiting for the departed node's acknowledgment take another route
+    give_up_link(departed_node)
+    link_receivers.pop(departed_node, None)
+
+def journal_record(*record):
+    if journaling:
+        with journal_lock:
+            topology_journal.append(record)
+
+
+# Our own links are reported by both ends
+def journal_link(neighbor_a, neighbor_b, latency):
+    journal_record('set', neighbor_a, neighbor_b, latency)
+    journal_record('set', neighbor_b, neighbor_a, latency)
+
+
+# Append the changes since the last save; the cost follows the number of changes, not the mesh size
 def save_connections_to_file():
-    file_path = 'connections_list.json'
-    with open(file_path, 'w') as file:
-        json.dump(connections_list, file)
-    print(f"Connections saved to {file_path}")
+    global journal_records, topology_journal
+    with journal_lock:
+        records, topology_journal = topology_journal, []
+    if journal_records + len(records) >= TOPOLOGY_SNAPSHOT_RECORDS or (
+            journal_records and time.monotonic() - journal_started >= TOPOLOGY_SNAPSHOT_INTERVAL):
+        write_topology_snapshot()
+        return
+    if records:
+        with open(TOPOLOGY_JOURNAL_FILE, 'a') as file:
+            if file.tell() == 0:
+                file.write(journal_header())
+            file.write(''.join(json.dumps(record) + '\n' for record in records))
+        journal_records += len(records)
+        print(f"Journaled {len(records)} topology changes to {TOPOLOGY_JOURNAL_FILE}")
+
+
+# Write the whole topology under a new generation to a temporary file and swap it in, then start
+# an empty journal of that generation. Should we stop between the two, the old journal is still
+# there, but its generation no longer matches the snapshot, so it is not replayed: its records
+# predate the snapshot and could bring back links or nodes that were removed since.
+def write_topology_snapshot():
+    global journal_records, journal_started, journal_generation
+    with routing_lock, journal_lock:
+        topology_journal.clear()
+        journal_generation = max(journal_generation + 1, int(time.time() * 1000))
+        snapshot = json.dumps({'generation': journal_generation, 'connections': connections_list})
+    write_file_atomically(CONNECTIONS_FILE, snapshot)
+    with open(TOPOLOGY_JOURNAL_FILE, 'w') as file:
+        file.write(journal_header())
+    journal_records = 0
+    journal_started = time.monotonic()
+    print(f"Connections saved to {CONNECTIONS_FILE}")
+
+
+# First line of the journal: the generation of the snapshot its records apply to
+def journal_header():
+    return json.dumps({'generation': journal_generation}) + '\n'
+
+
+def write_file_atomically(file_path, text):
+    temporary_path = f"{file_path}.tmp"
+    with open(temporary_path, 'w') as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, file_path)
+
+
+def save_route_state():
+    state = {'next_hops': next_hops, 'next_hop_epoch': next_hop_epoch, 'routing_table': routing_table,
+             'routing_table_default': routing_table_default, 'routing_table_epoch': routing_table_epoch}
+    write_file_atomically(ROUTE_STATE_FILE, json.dumps(state))
+
+
+def load_route_state():
+    global next_hop, next_hops, next_hop_epoch, routing_table, routing_table_default, routing_table_epoch
+    try:
+        with open(ROUTE_STATE_FILE, 'r') as file:
+            state = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return
+    next_hops, next_hop_epoch = state['next_hops'], state['next_hop_epoch']
+    next_hop = next_hops[0] if next_hops else None
+    routing_table, routing_table_default = state['routing_table'], state['routing_table_default']
+    routing_table_epoch = state['routing_table_epoch']
+    print(f"Restored next hops {', '.join(next_hops) or '-'} (epoch {next_hop_epoch}) and {len(routing_table)} routes")
+
+
+# Rebuild the topology and routes saved before the last shutdown. Our own links are not restored:
+# they come back through the usual ping/pong handshake with the cached neighbors.
+def warm_start():
+    global cached_neighbors, journaling
+    saved = load_connections_from_file()
+    cached_neighbors = [neighbor for neighbor, _ in saved.get(NODE_NAME, [])]
+    journaling = False
+    with routing_lock:
+        for node, links in saved.items():
+            if node != NODE_NAME and links:
+                apply_connections_report(node, [tuple(link) for link in links])
+    journaling = True
+    if NODE_NAME in GATEWAY_NODES and saved:
+        schedule_route_recompute()  # Publish the restored routes right away
+    load_route_state()
 
 
 def load_connections_from_file():
-    file_path = 'connections_list.json'
+    global journal_generation
+    file_path = CONNECTIONS_FILE
     try:
         with open(file_path, 'r') as file:
             connections = json.load(file)
         print(f"Connections loaded from {file_path}")
-        # Ensure all nodes have an entry in connections_list
-        for node in [NODE_NAME, *connections.keys()]:
-            if node not in connections:
-                connections[node] = []
-        return connections
     except FileNotFoundError:
         print(f"{file_path} not found. Starting with an empty connections list.")
+        connections = {}
+    except ValueError as e:  # Empty or cut short, e.g. by a crash while an older version wrote it
+        print(f"{file_path} is not readable ({e}). Starting with an empty connections list.")
+        connections = {}
+    if not isinstance(connections, dict):
+        print(f"{file_path} does not hold a connections list. Starting with an empty one.")
+        connections = {}
+    generation = None  # Snapshots written before generations were introduced hold the bare connections
+    if isinstance(connections.get('connections'), dict):
+        generation, connections = connections['generation'], connections['connections']
+        journal_generation = max(journal_generation, generation)
+    links = {node: dict(map(tuple, node_links)) for node, node_links in connections.items()}
+    replayed = replay_topology_journal(links, generation)
+    if replayed:
+        print(f"Replayed {replayed} topology changes from {TOPOLOGY_JOURNAL_FILE}")
+    if not links:
         return defaultdict(list)
+    connections = {node: list(node_links.items()) for node, node_links in links.items()}
+    # Ensure all nodes have an entry in connections_list
+    for node in [NODE_NAME, *connections.keys()]:
+        if node not in connections:
+            connections[node] = []
+    return connections
 
 
-# Connect to the MQTT broker
-client = mqtt.Client()
-client.on_message = on_message
-client.connect(BROKER_IP, 1883, 60)
-client.subscribe(DISCOVERY_TOPIC)
-client.subscribe(f"connections/{NODE_NAME}")
-client.subscribe(f"ping/{NODE_NAME}")
-client.subscribe(f"pong/{NODE_NAME}")
-client.subscribe(f"disconnect/{NODE_NAME}")
-client.subscribe(f"ack_request/{NODE_NAME}")
-client.subscribe(f"next_hop/{NODE_NAME}")
-client.subscribe(f"message/{NODE_NAME}")
-client.subscribe('disconnect/all')
-client.subscribe(f"connections_request/{NODE_NAME}")
-
-# Start the periodic presence broadcasting in a separate thread
-presence_thread = threading.Thread(target=broadcast_presence)
-presence_thread.daemon = True
-presence_thread.start()
-
-# Start the periodic connections broadcasting in a separate thread
-connections_broadcast_thread = threading.Thread(target=broadcast_connections_periodically)
-connections_broadcast_thread.daemon = True
-connections_broadcast_thread.start()
+# Apply the journal to links (node -> {neighbor: latency}) when it follows the snapshot of the given
+# generation; returns the number of records replayed
+def replay_topology_journal(links, generation):
+    try:
+        with open(TOPOLOGY_JOURNAL_FILE, 'r') as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return 0
+    journal_of = None  # Journals without a header predate generations and follow a bare snapshot
+    if lines and lines[0].startswith('{'):
+        try:
+            journal_of = json.loads(lines.pop(0))['generation']
+        except (ValueError, KeyError, TypeError):
+            journal_of = 'unreadable'  # Header cut short by a crash; cannot tell which snapshot it follows
+    if journal_of != generation:
+        print(f"Not replaying {TOPOLOGY_JOURNAL_FILE}: it follows snapshot generation {journal_of}, not {generation}")
+        return 0
+    replayed = 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            print(f"Stopping journal replay at an incomplete record: {line!r}")  # Cut short by a crash
+            break
+        if record[0] == 'set':
+            links.setdefault(record[1], {})[record[2]] = record[3]
+        elif record[0] == 'remove':
+            links.get(record[1], {}).pop(record[2], None)
+        elif record[0] == 'drop':
+            links.pop(record[1], None)
+        elif record[0] == 'clear':
+            links.clear()
+        replayed += 1
+    return replayed
+
+
+# Remember which nodes the current batch of topology changes touched
+def mark_route_changed(node):
+    pending_route_updates.add(node)
+
+
+def set_route_parent(node, parent):
+    old_parent = route_parent.get(node)
+    if old_parent is not None:
+        route_children[old_parent].discard(node)
+    if parent is None:
+        route_parent.pop(node, None)
+    else:
+        route_parent[node] = parent
+        route_children[parent].add(node)
+
+
+# Whether node should take the path through parent: cheaper paths over its current parent are always
+# taken, a path over another neighbor only when it wins by ROUTE_SWITCH_MARGIN (unless exact is set)
+def route_improves(node, parent, candidate, exact=False):
+    current = route_distance.get(node, float('inf'))
+    if exact or route_parent.get(node) == parent:
+        return candidate < current
+    return candidate < current * (1 - ROUTE_SWITCH_MARGIN)
+
+
+# Dijkstra relaxation seeded with the nodes whose cost just improved; detached nodes lost their
+# previous route, so they simply take the cheapest one
+def relax_route_tree(heap, detached=frozenset()):
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if distance > route_distance.get(node, float('inf')):
+            continue
+        for neighbor, weight in topology.neighbors(node).items():
+            candidate = distance + weight
+            if route_improves(neighbor, node, candidate, neighbor in detached):
+                mark_route_changed(neighbor)
+                route_distance[neighbor] = candidate
+                set_route_parent(neighbor, node)
+                heapq.heappush(heap, (candidate, neighbor))
+
+
+# Re-attach the subtree hanging below root after its tree link got worse or disappeared
+def rebuild_route_subtree(root):
+    subtree = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        subtree.append(node)
+        stack.extend(route_children[node])
+    detached = set(subtree)
+    for node in subtree:
+        mark_route_changed(node)
+        route_distance.pop(node, None)
+        set_route_parent(node, None)
+
+    # Seed every detached node with its best link to the intact part of the tree
+    heap = []
+    for node in subtree:
+        best_distance, best_parent = float('inf'), None
+        for neighbor, weight in topology.neighbors(node).items():
+            if neighbor not in detached and neighbor in route_distance:
+                candidate = route_distance[neighbor] + weight
+                if candidate < best_distance:
+                    best_distance, best_parent = candidate, neighbor
+        if best_parent is not None:
+            route_distance[node] = best_distance
+            set_route_parent(node, best_parent)
+            heapq.heappush(heap, (best_distance, node))
+    relax_route_tree(heap, detached)
+
+
+# The tree link above root got more expensive: keep the subtree where it is unless some node in it
+# now has an outside path that is cheaper by the switch margin, in which case it is rebuilt
+def reweight_route_subtree(root, distance):
+    delta = distance - route_distance[root]
+    subtree = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        subtree.append(node)
+        stack.extend(route_children[node])
+    members = set(subtree)
+    for node in subtree:
+        limit = (route_distance[node] + delta) * (1 - ROUTE_SWITCH_MARGIN)
+        for neighbor, weight in topology.neighbors(node).items():
+            if neighbor not in members and route_distance.get(neighbor, float('inf')) + weight < limit:
+                rebuild_route_subtree(root)
+                return
+    for node in subtree:
+        mark_route_changed(node)
+        route_distance[node] += delta
+
+
+# Add or re-weight the undirected link u-v and repair only the affected part of the tree
+def update_route_link(u, v, weight):
+    if u == v:
+        return
+    old_weight = topology.set_link(u, v, weight)
+    mark_route_changed(u)
+    mark_route_changed(v)
+    if old_weight is not None and weight > old_weight:
+        if route_parent.get(v) == u:
+            reweight_route_subtree(v, route_distance[u] + weight)
+        elif route_parent.get(u) == v:
+            reweight_route_subtree(u, route_distance[v] + weight)
+        return
+    heap = []
+    for a, b in ((u, v), (v, u)):
+        if a in route_distance and route_improves(b, a, route_distance[a] + weight):
+            route_distance[b] = route_distance[a] + weight
+            set_route_parent(b, a)
+            heapq.heappush(heap, (route_distance[b], b))
+    relax_route_tree(heap)
+
+
+def remove_route_link(u, v):
+    if not topology.remove_link(u, v):
+        return
+    mark_route_changed(u)
+    mark_route_changed(v)
+    if route_parent.get(v) == u:
+        rebuild_route_subtree(v)
+    elif route_parent.get(u) == v:
+        rebuild_route_subtree(u)
+
+
+def remove_route_node(node):
+    for neighbor in list(topology.neighbors(node)):
+        remove_route_link(node, neighbor)
+    route_children.pop(node, None)
+
+
+# Replace the connections reported by node and feed only the differences to the topology index
+def apply_connections_report(node, reported_connections):
+    with routing_lock:
+        if node in departed_gateways:
+            activate_gateway(node)
+        old_links = dict(connections_list[node])
+        new_links = dict(reported_connections)
+        connections_list[node] = reported_connections
+        node_id = topology.node_id(node)
+        for neighbor, latency in new_links.items():
+            if old_links.get(neighbor) != latency:
+                journal_record('set', node, neighbor, latency)
+                update_route_link(node_id, topology.node_id(neighbor), latency)
+        for neighbor in old_links.keys() - new_links.keys():
+            journal_record('remove', node, neighbor)
+            # The link survives while the other end still reports it
+            reverse_links = dict(connections_list.get(neighbor, []))
+            if node in reverse_links:
+                update_route_link(node_id, topology.node_id(neighbor), reverse_links[node])
+            else:
+                remove_route_link(node_id, topology.node_id(neighbor))
+
+
+# Make a returning gateway a root again; its old subtree and neighbors improve through relaxation
+def activate_gateway(gateway):
+    departed_gateways.discard(gateway)
+    gateway_id = topology.node_id(gateway)
+    mark_route_changed(gateway_id)
+    set_route_parent(gateway_id, None)
+    route_distance[gateway_id] = 0.0
+    relax_route_tree([(0.0, gateway_id)])
+    print(f"Gateway {gateway} is routed to again")
+
+
+def is_gateway_root(node_id):
+    return route_distance.get(node_id) == 0.0 and node_id not in route_parent
+
+
+# Routes are published by the first gateway in GATEWAY_NODES that has not departed; the
+# others keep their forest up to date so they can take over as soon as it leaves
+def is_route_controller():
+    for gateway in GATEWAY_NODES:
+        if gateway not in departed_gateways:
+            return gateway == NODE_NAME
+    return False
+
+
+def reset_route_tree():
+    with routing_lock:
+        topology.clear()
+        route_parent.clear()
+        route_children.clear()
+        route_distance.clear()
+        for gateway in GATEWAY_NODES:
+            if gateway not in departed_gateways:
+                route_distance[topology.node_id(gateway)] = 0.0
+        pending_route_updates.clear()
+        published_next_hops.clear()
+        published_routing_tables.clear()
+
+
+# Restart the quiet window on every topology change, but never push the run past the deadline
+def schedule_route_recompute():
+    global recompute_timer, recompute_deadline, recompute_generation
+    with recompute_lock:
+        now = time.time()
+        if recompute_timer is None:
+            recompute_deadline = now + RECOMPUTE_MAX_DELAY
+        else:
+            recompute_timer.cancel()
+        delay = max(0.0, min(RECOMPUTE_QUIET_WINDOW, recompute_deadline - now))
+        recompute_generation += 1
+        recompute_timer = schedule_later(delay, run_scheduled_recompute, recompute_generation)
+
+
+# One persist and one next-hop broadcast for all changes collected since the first was scheduled
+def run_scheduled_recompute(generation):
+    global recompute_timer
+    with recompute_lock:
+        if generation != recompute_generation:
+            return  # Superseded by a newer schedule that already restarted the window
+        recompute_timer = None
+    global route_controller_active, routing_tables_version, routing_tables_computed
+    with routing_lock:
+        save_connections_to_file()
+        if is_route_controller():
+            if not route_controller_active:
+                # Taking over from another gateway: nothing was published by us yet, so send everything
+                print(f"Gateway {NODE_NAME} is now publishing routes")
+                route_controller_active = True
+                pending_route_updates.update(route_distance)
+                routing_tables_version = -1
+                routing_tables_computed = 0.0
+            calculate_and_broadcast_next_hops()
+            calculate_and_broadcast_routing_tables()
+            print('calculating hops')
+        elif NODE_NAME in GATEWAY_NODES:
+            # Standby gateway: the forest is kept current, another gateway publishes it
+            route_controller_active = False
+            pending_route_updates.clear()
+            published_next_hops.clear()
+            published_routing_tables.clear()
 
-# Load previously saved connections from file
-# connections_list = load_connections_from_file()
 
-# Start the MQTT client loop
-client.loop_start()
+def send_next_hops(node, hops):
+    if speaks_binary([node], hops):
+        publish(f"next_hop/{node}", encode_next_hop(routing_epoch, hops))
+    else:
+        publish(f"next_hop/{node}", f"{routing_epoch}:{','.join(hops)}")
+
+
+def startup_topics():
+    topics = [DISCOVERY_TOPIC, f"connections/{NODE_NAME}", f"ping/{NODE_NAME}", f"pong/{NODE_NAME}",
+              f"disconnect/{NODE_NAME}", f"ack_request/{NODE_NAME}", f"next_hop/{NODE_NAME}", f"routes/{NODE_NAME}",
+              f"message/{NODE_NAME}", 'disconnect/all', f"connections_request/{NODE_NAME}", 'capabilities/+',
+              f"link_ack/{NODE_NAME}"]
+    if NODE_NAME in GATEWAY_NODES:
+        topics.append(f"route_request/{NODE_NAME}")
+        # Every gateway follows the connection reports so a standby can take over route publishing
+        topics += [f"connections/{gateway}" for gateway in GATEWAY_NODES if gateway != NODE_NAME]
+    return topics
+
+
+# (Re)subscribe with a single SUBSCRIBE packet once the broker accepted the connection
+def on_connect(client, userdata, flags, rc):
+    client.subscribe([(topic, 0) for topic in startup_topics()])
+    if fits_node_id(NODE_NAME):
+        codecs = [BINARY_CODEC, COMPRESSION_CODEC, LINK_CODEC] + ([COMPRESSION_DICTIONARY_ID] if COMPRESSION_DICTIONARY_ID else [])
+        publish(f"capabilities/{NODE_NAME}", ','.join(codecs), retain=True)
+    if FAST_START:
+        for neighbor in cached_neighbors:
+            measure_latency(neighbor)
+        if NODE_NAME not in GATEWAY_NODES:
+            for gateway in GATEWAY_NODES:
+                publish(f"route_request/{gateway}", NODE_NAME)
+
+
+# Drives paho from an asyncio loop: its socket is watched with add_reader/add_writer instead of
+# being served by the client's own network thread, and keepalives run from a task
+class AsyncioMqttAdapter:
+    def __init__(self, loop, mqtt_client):
+        self.loop = loop
+        self.misc_task = None
+        mqtt_client.on_socket_open = self.on_socket_open
+        mqtt_client.on_socket_close = self.on_socket_close
+        mqtt_client.on_socket_register_write = self.on_socket_register_write
+        mqtt_client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, mqtt_client, userdata, sock):
+        self.loop.add_reader(sock, mqtt_client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop(mqtt_client))
+
+    def on_socket_close(self, mqtt_client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+
+    def on_socket_register_write(self, mqtt_client, userdata, sock):
+        self.loop.add_writer(sock, mqtt_client.loop_write)
+
+    def on_socket_unregister_write(self, mqtt_client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self, mqtt_client):
+        while mqtt_client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+# Connect to the broker and start the node's background work; with RUNTIME 'asyncio' everything
+# is scheduled on loop (by default the running one) and nothing here blocks
+def start_node(loop=None):
+    global client, event_loop
+    if RUNTIME == 'asyncio':
+        event_loop = loop or asyncio.get_running_loop()
+
+    if FAST_START:
+        warm_start()
+    # From here on the files hold what is in memory and the journal grows from there
+    write_topology_snapshot()
+
+    # Connect to the MQTT broker
+    client = mqtt.Client()
+    client.on_message = on_message
+    client.on_connect = on_connect
+    if event_loop is not None:
+        AsyncioMqttAdapter(event_loop, client)
+    client.connect(BROKER_IP, 1883, 60)
+
+    if event_loop is None:
+        # Hand queued messages to the client, control traffic first
+        sender_thread = threading.Thread(target=send_outbound)
+        sender_thread.daemon = True
+        sender_thread.start()
+
+        # Handle received messages away from the network thread
+        if WORKER_THREADS > 1:
+            print(f"WORKER_THREADS is {WORKER_THREADS}, but the handlers are not thread-safe; using one worker")
+        for _ in range(min(WORKER_THREADS, 1)):
+            worker_thread = threading.Thread(target=process_work)
+            worker_thread.daemon = True
+            worker_thread.start()
+
+    if RELIABLE_LINKS:
+        run_periodic(retransmit_periodically)
+    run_periodic(broadcast_presence)
+    run_periodic(broadcast_connections_periodically)
+    run_periodic(flush_message_log_periodically)
+
+    if event_loop is None:
+        # Start the MQTT client loop
+        client.loop_start()
 
 
 def broadcast_departure():
-    client.publish('disconnect/all', NODE_NAME)
+    publish('disconnect/all', NODE_NAME)
     print(f"Broadcasting departure for node {NODE_NAME}")
 
 
 # Function to find the shortest path to the gateway
 def find_shortest_path_to_gateway():
-    G = nx.Graph()
-    for node, connections in connections_list.items():
-        for neighbor, latency in connections:
-            G.add_edge(node, neighbor, weight=latency, label=f"{latency:.4f}")
-    pos = get_fixed_layout(G)
-
-    if nx.has_path(G, NODE_NAME, GATEWAY_NODE):
-        shortest_path = nx.shortest_path(G, source=NODE_NAME, target=GATEWAY_NODE, weight='weight')
-        print(f"Shortest path to the gateway ({GATEWAY_NODE}): {' -> '.join(shortest_path)}")
-        return shortest_path, G, pos
+    shortest_path = get_route_to_gateway(NODE_NAME)
+    if shortest_path:
+        print(f"Shortest path to the gateway ({shortest_path[-1]}): {' -> '.join(shortest_path)}")
+        return shortest_path
     else:
-        print(f"No path found to the gateway ({GATEWAY_NODE}) from {NODE_NAME}")
-        return None, G, pos
+        print(f"No path found to a gateway ({', '.join(GATEWAY_NODES)}) from {NODE_NAME}")
+        return None
+
+
+# Pick one of the equal-cost next hops by hashing the flow, so a flow always takes the same path.
+# A flow is a (source, destination) pair; the node name salts the hash so hops do not all agree.
+def select_next_hop(source, destination):
+    if len(next_hops) < 2:
+        return next_hop
+    flow_hash = zlib.crc32(f"{NODE_NAME}:{source}>{destination}".encode())
+    return next_hops[flow_hash % len(next_hops)]
+
+
+# Next hop for a flow; without a destination it goes to the nearest gateway ('' if there is no route)
+def route_next_hop(source, destination):
+    if destination is None:
+        hop = select_next_hop(source, 'gateway')
+        for gateway in GATEWAY_NODES:
+            hop = hop or routing_table.get(gateway, routing_table_default)
+        return hop
+    return routing_table.get(destination, routing_table_default)
+
+
+# Function to forward a message; without a destination it goes to the nearest gateway.
+# Messages we originate get the next sequence number of this node as their id.
+def forward_message_to_next_hop(message, source, destination=None, seq=None):
+    if seq is None and source == NODE_NAME:
+        seq = next_message_sequence()
+        is_duplicate(NODE_NAME, seq)  # Recognise our own message should it come back
+    hop = route_next_hop(source, destination)
+    if not hop:
+        print(f"No route to {destination or 'a gateway'}, dropping message from {source}")
+        return
+    if MESSAGE_BATCHING and speaks_binary([hop]) and len(message.encode()) < BATCH_MAX_BYTES:
+        try:
+            add_to_batch(hop, source, destination, seq, message)
+            return
+        except ValueError as e:  # Node name too long for the binary frame
+            print(f"Sending message unbatched: {e}")
+    flush_batch((hop, source, destination))  # Keep the flow in order
+    publish_data(hop, source, destination, [(seq, message)])
+
+
+# Send (seq, text) entries of one flow to hop: as a binary data frame when that batches or
+# compresses them and the hop reads binary, otherwise as plain text messages
+def publish_data(hop, source, destination, entries):
+    if speaks_binary([hop]):
+        try:
+            frames = encode_data_frames(source, destination, entries)
+        except ValueError as e:  # Node name too long for the binary frame, or far too many fragments
+            print(f"Sending data as text: {e}")
+            frames = None
+        if frames is not None and len(frames) > 1:
+            with stream_lock:
+                fragment_streams.append([hop, source, destination, deque(frames)])
+            feed_fragment_streams()
+            print(f"Sending {len(entries)} message(s) to {hop} in {len(frames)} fragments")
+            return
+        if frames is not None:
+            send_data(hop, frames[0], source, destination)
+            print(f"Forwarded {len(entries)} message(s) to {hop} in 1 frame")
+            return
+    for seq, text in entries:
+        publish_data_message(hop, source, destination, seq, text)
+
+
+# Send waiting fragments while there is room and budget for them; called whenever data went out
+def feed_fragment_streams():
+    global stream_budget, stream_refilled, stream_timer
+    with stream_lock:
+        now = time.monotonic()
+        stream_budget = min(FRAGMENT_STREAM_BURST, stream_budget + (now - stream_refilled) * FRAGMENT_STREAM_RATE)
+        stream_refilled = now
+        while fragment_streams:
+            hop, source, destination, frames = fragment_streams[0]
+            while frames:
+                size = len(frames[0])
+                if stream_budget < size:
+                    if stream_timer is None:
+                        stream_timer = schedule_later((size - stream_budget) / FRAGMENT_STREAM_RATE, resume_fragment_streams)
+                    return
+                if not fragment_room(hop, size):
+                    return
+                stream_budget -= size
+                send_data(hop, frames.popleft(), source, destination)
+            fragment_streams.popleft()
+
+
+def resume_fragment_streams():
+    global stream_timer
+    with stream_lock:
+        stream_timer = None
+    feed_fragment_streams()
+
+
+def fragment_room(hop, size):
+    if RELIABLE_LINKS and peers_support([hop], LINK_CODEC):
+        sender = link_senders.get(hop)
+        return sender is None or len(sender.backlog) < LINK_WINDOW
+    return outbound_data_bytes + size <= FRAGMENT_QUEUE_BYTES
+
+
+def publish_data_message(hop, source, destination, seq, message):
+    # Include the source and message id (and destination, unless any gateway will do) in the message
+    origin = source if seq is None else f"{source}#{seq}"
+    full_message = f"{origin}:{message}" if destination is None else f"{origin}>{destination}:{message}"
+    send_data(hop, full_message.encode(), source, destination)
+    print(f"Forwarded message to {hop}")
 
 
-# Function to forward a message
-def forward_message_to_next_hop(message, source):
-    global next_hop
-    hop = next_hop
-    # Include the source node information in the message
-    full_message = f"{source}:{message}"
-    client.publish(f"message/{hop}", full_message)
+def add_to_batch(hop, source, destination, seq, message):
+    # Fail before queueing when the names do not fit the binary frame
+    node_id_bytes(source)
+    node_id_bytes(destination or '')
+    key = (hop, source, destination)
+    with batch_lock:
+        batch = pending_batches.get(key)
+        if batch is None:
+            batch = pending_batches[key] = [[], 0, schedule_later(BATCH_MAX_DELAY, flush_batch, key)]
+        batch[0].append((seq, message))
+        batch[1] += len(message.encode())
+        full = batch[1] >= BATCH_MAX_BYTES
+    if full:
+        flush_batch(key)
+
+
+def flush_batch(key):
+    with batch_lock:
+        batch = pending_batches.pop(key, None)
+    if batch is None:
+        return
+    entries, _, timer = batch
+    timer.cancel()
+    hop, source, destination = key
+    publish_data(hop, source, destination, entries)
+
+
+# Relay a text message without decoding or rebuilding it: its header stays the same on every hop
+def relay_data_message(message):
+    hop = route_next_hop(message.source, message.destination)
+    if not hop:
+        print(f"No route to {message.destination or 'a gateway'}, dropping message from {message.source}")
+        return
+    flush_batch((hop, message.source, message.destination))  # Keep the flow in order
+    send_data(hop, message.payload, message.source, message.destination)
     print(f"Forwarded message to {hop}")
 
 
+# Relay a data frame untouched; a next hop without the binary codec gets its messages as text
+def forward_data_frame(frame):
+    hop = route_next_hop(frame.source, frame.destination)
+    if not hop:
+        print(f"No route to {frame.destination or 'a gateway'}, dropping data frame from {frame.source}")
+        return
+    flush_batch((hop, frame.source, frame.destination))
+    if speaks_binary([hop]):
+        send_data(hop, frame.frame, frame.source, frame.destination)
+        print(f"Forwarded data frame to {hop}")
+        return
+    if frame.fragment is not None:
+        # Relays pass fragments on one by one and never reassemble, so a text-only hop cannot get them
+        print(f"Next hop {hop} cannot take fragments, dropping fragment {frame.fragment} of {frame.seq} from {frame.source}")
+        return
+    try:
+        entries = unpack_data_frame(frame)
+    except (ValueError, struct.error, zlib.error) as e:
+        print(f"Dropping undecodable data frame from {frame.source}: {e}")
+        return
+    for seq, text in entries:
+        publish_data_message(hop, frame.source, frame.destination, seq, text)
+
+
+# Every data publish goes through here; source and destination let a frame be routed again
+# should its link be given up
+def send_data(hop, payload, source, destination):
+    if RELIABLE_LINKS and peers_support([hop], LINK_CODEC):
+        link_send(hop, payload, source, destination)
+    else:
+        publish(f"message/{hop}", payload, flow=source)
+
+
+class LinkSender:
+    def __init__(self):
+        self.next_seq = int(time.time() * 1e6)  # A restarted sender starts a new session far ahead
+        self.unacked = OrderedDict()  # Sequence number -> [payload, source, destination, sent at, retries]
+        self.backlog = deque()  # (payload, source, destination) waiting for room in the window
+
+
+def link_rto(hop, retries):
+    rtt = latencies[NODE_NAME].get(hop) or LINK_DEFAULT_RTT
+    return max(LINK_MIN_RTO, LINK_RTO_FACTOR * rtt) * 2 ** retries
+
+
+def encode_link_frame(seq, base, payload):
+    return encode_binary(KIND_LINK, NODE_NAME, LINK_HEADER.pack(seq, base) + payload)
+
+
+def link_send(hop, payload, source, destination):
+    with link_lock:
+        sender = link_senders.get(hop)
+        if sender is None:
+            sender = link_senders[hop] = LinkSender()
+        if len(sender.backlog) >= LINK_BACKLOG:
+            sender.backlog.popleft()
+            print(f"Link backlog to {hop} is full, dropping its oldest frame")
+        sender.backlog.append((bytes(payload), source, destination))
+        fill_link_window(hop, sender)
+
+
+def fill_link_window(hop, sender):
+    while sender.backlog and len(sender.unacked) < LINK_WINDOW:
+        payload, source, destination = sender.backlog.popleft()
+        seq = sender.next_seq
+        sender.next_seq += 1
+        sender.unacked[seq] = [payload, source, destination, time.monotonic(), 0]
+        publish(f"message/{hop}", encode_link_frame(seq, next(iter(sender.unacked)), payload), flow=source)
+
+
+def parse_binary_only(payload):
+    raise ValueError("expected a binary frame")
+
+
+@message_handler('link_ack', parse_binary_only)
+def handle_link_ack(target, ack):
+    with link_lock:
+        sender = link_senders.get(ack.sender)
+        if sender is None:
+            return
+        while sender.unacked and next(iter(sender.unacked)) <= ack.seq:
+            sender.unacked.popitem(last=False)
+        fill_link_window(ack.sender, sender)
+    if fragment_streams:
+        feed_fragment_streams()
+
+
+# Accept a link frame and return the wrapped payloads that are now in order, acknowledging them
+def receive_link_frame(frame):
+    state = link_receivers.get(frame.sender)
+    if state is None or frame.base > state[0]:
+        # First frame from this sender, or it started a new session (its window moved past what we acked)
+        state = link_receivers[frame.sender] = [frame.base, {}]
+    buffered = state[1]
+    if state[0] <= frame.seq < state[0] + LINK_WINDOW:
+        buffered.setdefault(frame.seq, bytes(frame.payload))
+    ready = []
+    while state[0] in buffered:
+        ready.append(buffered.pop(state[0]))
+        state[0] += 1
+    publish(f"link_ack/{frame.sender}", encode_binary(KIND_LINK_ACK, NODE_NAME, LINK_ACK.pack(state[0] - 1)))
+    return ready
+
+
+# Stop using the link to hop and route its unacknowledged and waiting frames again. Frames that
+# routing still sends to hop are parked until the routes change.
+def give_up_link(hop):
+    with link_lock:
+        sender = link_senders.pop(hop, None)
+        if sender is None:
+            return
+        pending = [entry[:3] for entry in sender.unacked.values()] + list(sender.backlog)
+        for payload, source, destination in pending:
+            new_hop = route_next_hop(source, destination)
+            if new_hop and new_hop != hop:
+                send_data(new_hop, payload, source, destination)
+            else:
+                park_frame(payload, source, destination)
+        if parked_frames:
+            print(f"No other route for frames sent to {hop}, {len(parked_frames)} frame(s) wait for new routes")
+
+
+def park_frame(payload, source, destination):
+    if len(parked_frames) >= LINK_BACKLOG:
+        parked_frames.popleft()
+        print("Too many frames wait for new routes, dropping the oldest")
+    parked_frames.append((payload, source, destination))
+
+
+# Called when new routes arrive; frames that still have no route stay parked
+def resend_parked_frames():
+    with link_lock:
+        if not parked_frames:
+            return
+        frames = list(parked_frames)
+        parked_frames.clear()
+        for payload, source, destination in frames:
+            hop = route_next_hop(source, destination)
+            if hop:
+                send_data(hop, payload, source, destination)
+            else:
+                park_frame(payload, source, destination)
+        print(f"Re-sent {len(frames) - len(parked_frames)} parked frame(s) on the new routes")
+
+
+def retransmit_periodically():
+    while True:
+        yield LINK_TICK
+        now = time.monotonic()
+        with link_lock:
+            for hop, sender in list(link_senders.items()):
+                base = next(iter(sender.unacked), None)
+                for seq, entry in sender.unacked.items():
+                    if now - entry[3] < link_rto(hop, entry[4]):
+                        continue
+                    if entry[4] >= LINK_MAX_RETRIES:
+                        print(f"Link to {hop} is not acknowledging, routing its frames elsewhere")
+                        give_up_link(hop)
+                        break
+                    entry[3] = now
+                    entry[4] += 1
+                    publish(f"message/{hop}", encode_link_frame(seq, base, entry[0]), flow=entry[1])
+        if fragment_streams:
+            feed_fragment_streams()  # A given-up link has room again
+
+
+# Compact wire form of a forwarding table: the most common next hop becomes the default and
+# only the destinations that differ from it are listed, then the whole text is zlib-compressed
+def encode_routing_table(epoch, table):
+    hop_counts = defaultdict(int)
+    for hop in table.values():
+        hop_counts[hop] += 1
+    default = max(hop_counts, key=hop_counts.get) if hop_counts else ''
+    exceptions = ','.join(f"{destination}={hop}" for destination, hop in sorted(table.items()) if hop != default)
+    return zlib.compress(f"{epoch}|{default}|{exceptions}".encode())
+
+
+def decode_routing_table(data):
+    epoch, default, exceptions = zlib.decompress(data).decode().split('|', 2)
+    table = {}
+    for entry in exceptions.split(',') if exceptions else []:
+        destination, hop = entry.split('=', 1)
+        table[destination] = hop
+    return RoutingTableUpdate(int(epoch), default, table)
+
+
+# Forwarding tables arrive zlib-compressed; decode_routing_table is their parser
+@message_handler('routes', decode_routing_table)
+def handle_routing_table(target, update):
+    global routing_table, routing_table_default, routing_table_epoch
+    epoch, default, table = update
+    if epoch <= routing_table_epoch:
+        print(f"Ignoring stale routing table from epoch {epoch} (current epoch {routing_table_epoch})")
+        return
+    routing_table, routing_table_default, routing_table_epoch = table, default, epoch
+    print(f"Received routing table (epoch {epoch}): default {default or '-'}, {len(table)} exceptions")
+    save_route_state()
+    resend_parked_frames()
+
+
+# Walk the shortest-path forest from node up to its nearest gateway
+def get_route_to_gateway(node):
+    node_id = topology.node_ids.get(node)
+    if node_id not in route_distance:
+        return None
+    path = [node_id]
+    while path[-1] in route_parent:
+        path.append(route_parent[path[-1]])
+    return [topology.node_names[hop] for hop in path]
+
+
+# Tree parent first, then the other neighbors whose path cost is within the ECMP tolerance.
+# Only strictly closer neighbors qualify, which keeps the multipath routes loop-free.
+def get_equal_cost_next_hops(node_id):
+    parent = route_parent.get(node_id)
+    if parent is None:
+        return ()
+    distance = route_distance[node_id]
+    limit = distance * (1 + ECMP_TOLERANCE)
+    alternatives = []
+    for neighbor, weight in topology.neighbors(node_id).items():
+        if neighbor != parent and route_distance.get(neighbor, float('inf')) < distance:
+            cost = route_distance[neighbor] + weight
+            if cost <= limit:
+                alternatives.append((cost, topology.node_names[neighbor]))
+    alternatives.sort()
+    hops = [topology.node_names[parent]] + [name for _, name in alternatives]
+    return tuple(hops[:ECMP_MAX_PATHS])
+
+
+# Single-source Dijkstra over the topology index; parent[v] is v's next hop towards source
+# and distance[v] its path cost
+def shortest_path_parents(source):
+    distance = {source: 0.0}
+    parent = {}
+    heap = [(0.0, source)]
+    while heap:
+        cost, node = heapq.heappop(heap)
+        if cost > distance[node]:
+            continue
+        for neighbor, weight in topology.neighbors(node).items():
+            candidate = cost + weight
+            if candidate < distance.get(neighbor, float('inf')):
+                distance[neighbor] = candidate
+                parent[neighbor] = node
+                heapq.heappush(heap, (candidate, neighbor))
+    return distance, parent
+
+
+# Any-to-any forwarding tables from one shortest-path tree per destination: in the tree rooted
+# at a destination, every node's parent is its next hop towards that destination ('' = no route)
+def calculate_routing_tables():
+    names = topology.node_names
+    nodes = [node for node in range(len(names)) if topology.neighbors(node)]
+    tables = {names[node]: {} for node in nodes}
+    for destination in nodes:
+        distance, parent = shortest_path_parents(destination)
+        for node in nodes:
+            if node != destination:
+                hop = sticky_next_hop(node, destination, distance, parent)
+                tables[names[node]][names[destination]] = names[hop] if hop is not None else ''
+    return tables
+
+
+# Keep the previously published next hop while the new shortest path does not beat it by
+# ROUTE_SWITCH_MARGIN. The kept hop must be strictly closer to the destination, so no loops form.
+def sticky_next_hop(node, destination, distance, parent):
+    if node not in parent:
+        return None
+    previous = published_routing_tables.get(topology.node_names[node], {}).get(topology.node_names[destination])
+    hop = topology.node_ids.get(previous)
+    weight = topology.neighbors(node).get(hop) if hop is not None else None
+    if weight is None or hop == parent[node] or distance.get(hop, float('inf')) >= distance[node]:
+        return parent[node]
+    if distance[node] < (distance[hop] + weight) * (1 - ROUTE_SWITCH_MARGIN):
+        return parent[node]
+    return hop
+
+
+# Publish compressed forwarding tables to the nodes whose table changed since it was last sent
+def calculate_and_broadcast_routing_tables():
+    global routing_tables_version, routing_tables_computed, routing_tables_timer
+    global routing_epoch, routing_table, routing_table_default
+    if routing_tables_version == topology.version:
+        return
+    wait = routing_tables_computed + ROUTING_TABLE_MIN_INTERVAL - time.time()
+    if wait > 0:
+        if routing_tables_timer is None:
+            routing_tables_timer = schedule_later(wait, run_deferred_routing_tables)
+        return
+    routing_tables_computed = time.time()
+    routing_tables_version = topology.version
+    tables = calculate_routing_tables()
+    updates = {node: table for node, table in tables.items() if published_routing_tables.get(node) != table}
+    if not updates:
+        return
+
+    routing_epoch = max(routing_epoch + 1, int(time.time() * 1000))
+    for node, table in updates.items():
+        published_routing_tables[node] = table
+        if node == NODE_NAME:
+            routing_table, routing_table_default = table, ''
+            resend_parked_frames()
+            continue
+        publish(f"routes/{node}", encode_routing_table(routing_epoch, table))
+        print(f"Sent routing table for node {node} (epoch {routing_epoch})")
+
+
+# Catch up on the topology changes that arrived within ROUTING_TABLE_MIN_INTERVAL of the last run
+def run_deferred_routing_tables():
+    global routing_tables_timer
+    with routing_lock:
+        routing_tables_timer = None
+        if is_route_controller() and route_controller_active:
+            calculate_and_broadcast_routing_tables()
+
+
+# Send a new routing epoch only to the nodes whose next hops actually changed
 def calculate_and_broadcast_next_hops():
-    G = nx.Graph()
-    for node, connections in connections_list.items():
-        for neighbor, latency in connections:
-            G.add_edge(node, neighbor, weight=latency, label=f"{latency:.4f}")
-    pos = get_fixed_layout(G)
-
-    if G.has_node(GATEWAY_NODE):
-        for node in G.nodes:
-            if node != GATEWAY_NODE:
-                if nx.has_path(G, node, GATEWAY_NODE):
-                    shortest_path = nx.shortest_path(G, source=node, target=GATEWAY_NODE, weight='weight')
-                    next_hop = shortest_path[1] if len(shortest_path) > 1 else GATEWAY_NODE
-                    client.publish(f"next_hop/{node}", next_hop)
-                    print(f"Sent next hop {next_hop} for node {node}")
-                else:
-                    print(f"No path found to the gateway ({GATEWAY_NODE}) from {node}")
+    global routing_epoch
+    # A changed path cost also changes which of its neighbors' paths count as equal cost
+    changed_nodes = set(pending_route_updates)
+    for node_id in pending_route_updates:
+        changed_nodes.update(topology.neighbors(node_id))
+    pending_route_updates.clear()
+    updates = {}
+    for node_id in changed_nodes:
+        if is_gateway_root(node_id):
+            continue
+        node = topology.node_names[node_id]
+        hops = get_equal_cost_next_hops(node_id)
+        if not hops:
+            if published_next_hops.pop(node, None) is not None:
+                print(f"No path found to a gateway ({', '.join(GATEWAY_NODES)}) from {node}")
+        elif published_next_hops.get(node) != hops:
+            updates[node] = hops
+    if not updates:
+        return
+
+    routing_epoch = max(routing_epoch + 1, int(time.time() * 1000))
+    for node, hops in updates.items():
+        send_next_hops(node, hops)
+        published_next_hops[node] = hops
+        print(f"Sent next hops {', '.join(hops)} for node {node} (epoch {routing_epoch})")
 
 
 def reset_connections():
     global NEIGHBORS, latencies, connection_slots, accepted_connections, connections_list
     for neighbor in NEIGHBORS:
-        client.publish(f"disconnect/{neighbor}", NODE_NAME)
+        publish(f"disconnect/{neighbor}", NODE_NAME)
         print(f"Notified {neighbor} about disconnection.")
 
-    client.publish('disconnect/all', NODE_NAME)
+    publish('disconnect/all', NODE_NAME)
     print(f"Gateway Node {NODE_NAME} has announced its departure.")
 
     # Reset local connection lists
-    NEIGHBORS = set()
-    latencies = defaultdict(dict)
-    connection_slots[NODE_NAME] = MAX_CONNECTIONS
-    for neighbor in accepted_connections[NODE_NAME]:
-        connection_slots[neighbor] += 1
-    accepted_connections[NODE_NAME] = set()
-    connections_list = defaultdict(list)  # Reset connections list
-    save_connections_to_file()
+    with routing_lock:
+        NEIGHBORS = set()
+        latencies = defaultdict(dict)
+        latency_samples.clear()
+        connection_slots[NODE_NAME] = MAX_CONNECTIONS
+        for neighbor in accepted_connections[NODE_NAME]:
+            connection_slots[neighbor] += 1
+        accepted_connections[NODE_NAME] = set()
+        connections_list = defaultdict(list)  # Reset connections list
+        journal_record('clear')
+        reset_route_tree()
+        save_connections_to_file()
     # Broadcast presence to allow reconnection
-    client.publish(DISCOVERY_TOPIC, NODE_NAME)
+    publish(DISCOVERY_TOPIC, NODE_NAME)
     print("Reset connections and broadcasting presence.")
 
-    # Allow time for all nodes to reset and reconnect
-    time.sleep(1)
+    # Allow time for all nodes to reset and reconnect (the event loop must not be held up)
+    if event_loop is None:
+        time.sleep(1)
 
 
 # Interactive loop to send messages or visualize the network
 def leave_network():
     broadcast_departure()
-    client.loop_stop()
+    publish(f"capabilities/{NODE_NAME}", '', retain=True)
+    flush_outbound()  # Let the departure reach the broker before the loop stops
+    flush_message_log()
+    if event_loop is None:
+        # Queued behind the departure; the network thread writes both before it stops.
+        # Under asyncio the loop still has to run for that, see close_client.
+        client.disconnect()
+        client.loop_stop()
 
 
 # def forward_message(message):
@@ -436,30 +2333,108 @@ def leave_network():
 #         print(f"Cannot forward message, no path to gateway ({GATEWAY_NODE}) found.")
 
 
-try:
-    while True:
-        user_input = input("Enter a command (send <message> / show / leave /  reset): ")
-        if user_input.startswith("send "):
-            message = user_input[5:]
-            forward_message_to_next_hop(message, NODE_NAME)
-        elif user_input == "show":
-            print(accepted_connections)
-            print(latencies)
-            print(connection_slots)
-            print(connections_list)
-            print(next_hop)
-            # _, G, pos = find_shortest_path_to_gateway()
-            # display_network_graph(G, pos)
-        elif user_input == "leave":
+COMMAND_PROMPT = "Enter a command (send <message> / sendto <node> <message> / show / leave /  reset): "
+
+
+# Run one console command; returns False once the node should stop
+def handle_command(user_input):
+    if user_input.startswith("send "):
+        message = user_input[5:]
+        forward_message_to_next_hop(message, NODE_NAME)
+    elif user_input.startswith("sendto "):
+        _, destination, message = (user_input.split(' ', 2) + [''])[:3]
+        forward_message_to_next_hop(message, NODE_NAME, destination)
+    elif user_input == "show":
+        print(accepted_connections)
+        print(latencies)
+        print(connection_slots)
+        print(connections_list)
+        print(next_hops)
+        print(routing_table, routing_table_default)
+        print(f"Routing epoch: {routing_epoch if is_route_controller() else next_hop_epoch}")
+        print(f"Gateways: {[gateway for gateway in GATEWAY_NODES if gateway not in departed_gateways]}")
+        print(f"Peer codecs: {peer_capabilities}")
+        print(f"Duplicate messages dropped: {duplicates_dropped} ({len(seen_messages)} ids remembered)")
+        print(f"Messages being reassembled: {len(reassembly_buffers)} ({reassembly_bytes} bytes)")
+        print(f"Outbound queue: {len(outbound_control[0])} probes, {len(outbound_control[1])} control, "
+              f"{outbound_data_bytes} data bytes from {len(outbound_data)} origins, {outbound_dropped} dropped")
+        print(f"Reliable links: {({hop: (len(sender.unacked), len(sender.backlog)) for hop, sender in link_senders.items()})}")
+        print("Message handlers:")
+        print_handler_stats()
+        # G = topology.snapshot().to_graph()
+        # display_network_graph(G, get_fixed_layout(G))
+    elif user_input == "leave":
+        leave_network()
+        return False
+    elif user_input == "reset" and NODE_NAME in GATEWAY_NODES:
+        reset_connections()
+    elif user_input == "exit":
+        return False
+    return True
+
+
+CLIENT_CLOSE_TIMEOUT = 2.0  # Seconds the loop keeps running for paho to write what is still queued
+
+
+# Console input blocks, so under asyncio it is read on a daemon thread and the commands themselves
+# run on the loop. An executor thread would keep asyncio.run from returning on Ctrl-C until Enter.
+async def read_command():
+    future = event_loop.create_future()
+
+    def resolve(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def read():
+        try:
+            event_loop.call_soon_threadsafe(resolve, input(COMMAND_PROMPT), None)
+        except Exception as e:
+            event_loop.call_soon_threadsafe(resolve, None, e)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+# Disconnect and keep the loop running until paho wrote everything queued (the departure and
+# the DISCONNECT after it) and closed the socket
+async def close_client(timeout=CLIENT_CLOSE_TIMEOUT):
+    client.disconnect()
+    deadline = event_loop.time() + timeout
+    while client.socket() is not None and event_loop.time() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def run_node_async():
+    start_node()
+    try:
+        while handle_command(await read_command()):
+            pass
+    except asyncio.CancelledError:
+        # Ctrl-C: asyncio.run cancels this task and raises KeyboardInterrupt once it has finished,
+        # so the node leaves here, while the loop can still deliver the departure
+        leave_network()
+        await close_client()
+        raise
+    await close_client()
+
+
+if __name__ == '__main__':
+    try:
+        if RUNTIME == 'asyncio':
+            asyncio.run(run_node_async())
+        else:
+            start_node()
+            while handle_command(input(COMMAND_PROMPT)):
+                pass
+    except KeyboardInterrupt:
+        if RUNTIME != 'asyncio':  # run_node_async has already left, and its loop is closed by now
             leave_network()
-            break
-        elif user_input == "reset" and NODE_NAME == GATEWAY_NODE:
-            reset_connections()
-        elif user_input == "exit":
-            break
-except KeyboardInterrupt:
-    leave_network()
-    print("Interrupted by user")
+        print("Interrupted by user")
 
-# Clean up
-client.loop_stop()
+    # Clean up
+    flush_message_log()
+    client.loop_stop()
@@ -0,0 +1,367 @@
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import math
+import os
+import random
+import selectors
+import statistics
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+import networkx as nx
+
+# Runs many copies of 3-Dynamicrouting.py in one process against an in-process broker stand-in.
+# Every node is its own module instance on the asyncio runtime; they all share one event loop whose
+# clock is virtual, so minutes of protocol time (presence and report timers) pass in seconds.
+NODE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '3-Dynamicrouting.py')
+PAHO_MODULES = ('paho', 'paho.mqtt', 'paho.mqtt.client')
+
+# Topics that model the radio: they only reach nodes linked to the sender in the generated topology,
+# after that link's latency. Everything else (reports to the gateway, next hops, routes, capabilities)
+# goes over the shared broker backhaul and reaches every subscriber.
+LINK_TOPICS = ('discovery', 'ping', 'pong', 'ack_request', 'connections_request', 'message', 'link_ack')
+DATA_TOPICS = ('message', 'link_ack')
+BACKHAUL_LATENCY = 0.002  # Seconds
+LINK_LATENCY_RANGE = (0.005, 0.03)  # Seconds, drawn per link (scaled by distance for random geometric)
+
+CHECK_INTERVAL = 0.1  # Seconds between route checks
+SETTLE_TIME = 20.0  # Routes must stay unchanged this long to count as converged
+MESSAGE_INTERVAL = 0.2  # Seconds between the test messages a node sends
+
+
+# Event loop whose clock only moves when there is nothing left to do: instead of blocking until the
+# next timer, the selector jumps the clock forward to it
+class VirtualSelector(selectors.SelectSelector):
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events and timeout:
+            self.loop.now += timeout
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.now = 0.0
+        selector = VirtualSelector()
+        super().__init__(selector)
+        selector.loop = self
+
+    def time(self):
+        return self.now
+
+
+# Stands in for the time module inside a node so its timestamps follow the virtual clock
+class SimClock:
+    def __init__(self, loop, epoch):
+        self.loop = loop
+        self.epoch = epoch
+
+    def time(self):
+        return self.epoch + self.loop.time()
+
+    def monotonic(self):
+        return self.loop.time()
+
+    def sleep(self, seconds):
+        pass  # Only the threaded runtime sleeps
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def topic_matches(pattern, topic):
+    pattern_levels, topic_levels = pattern.split('/'), topic.split('/')
+    for index, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or level not in ('+', topic_levels[index]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+class SimMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class SimBroker:
+    def __init__(self, loop, graph):
+        self.loop = loop
+        self.graph = graph
+        self.clients = {}  # Node -> SimClient
+        self.retained = {}  # Topic -> payload
+        self.counts = defaultdict(int)  # Topic prefix -> messages published
+
+    def publish(self, sender, topic, payload, retain):
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        else:
+            payload = bytes(payload)
+        prefix, _, target = topic.partition('/')
+        self.counts[prefix] += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        over_link = prefix in LINK_TOPICS or (prefix == 'disconnect' and target != 'all')
+        for node, client in self.clients.items():
+            if not client.subscribed(topic):
+                continue
+            if not over_link:
+                delay = BACKHAUL_LATENCY
+            elif self.graph.has_edge(sender, node):
+                delay = self.graph[sender][node]['latency']
+            else:
+                continue
+            self.loop.call_later(delay, client.deliver, topic, payload)
+
+    def control_messages(self):
+        return sum(count for prefix, count in self.counts.items() if prefix not in DATA_TOPICS)
+
+
+# The subset of paho's Client that the node uses, bound to one node of the broker stand-in
+class SimClient:
+    def __init__(self, broker, node):
+        self.broker = broker
+        self.node = node
+        self.patterns = []
+        self.connected = False
+        self.on_message = None
+        self.on_connect = None
+
+    def connect(self, host, port=1883, keepalive=60):
+        self.broker.clients[self.node] = self
+        self.connected = True
+        self.broker.loop.call_soon(self.on_connect, self, None, {}, 0)
+
+    def disconnect(self):
+        self.connected = False
+        self.broker.clients.pop(self.node, None)
+
+    def subscribe(self, topic, qos=0):
+        topics = [entry[0] for entry in topic] if isinstance(topic, list) else [topic]
+        self.patterns += topics
+        for retained_topic, payload in self.broker.retained.items():
+            if any(topic_matches(pattern, retained_topic) for pattern in topics):
+                self.broker.loop.call_later(BACKHAUL_LATENCY, self.deliver, retained_topic, payload)
+        return 0, 1
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.connected:
+            self.broker.publish(self.node, topic, payload, retain)
+
+    def subscribed(self, topic):
+        return any(topic_matches(pattern, topic) for pattern in self.patterns)
+
+    def deliver(self, topic, payload):
+        if self.connected:
+            self.on_message(self, None, SimMessage(topic, payload))
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+# paho.mqtt.client replacement for one node: its Client() is that node's connection to the broker
+def sim_paho_modules(broker, node):
+    client_module = types.ModuleType('paho.mqtt.client')
+    client_module.Client = lambda *args, **kwargs: SimClient(broker, node)
+    client_module.MQTTMessage = SimMessage
+    client_module.MQTT_ERR_SUCCESS = 0
+    mqtt_module = types.ModuleType('paho.mqtt')
+    mqtt_module.client = client_module
+    paho_module = types.ModuleType('paho')
+    paho_module.mqtt = mqtt_module
+    return dict(zip(PAHO_MODULES, (paho_module, mqtt_module, client_module)))
+
+
+def load_node(name, gateways, broker, state_dir, epoch):
+    environment = {'MESH_NODE_NAME': name, 'MESH_GATEWAYS': ','.join(gateways), 'MESH_RUNTIME': 'asyncio',
+                   'MESH_STATE_DIR': state_dir}
+    saved_modules = {module: sys.modules.get(module) for module in PAHO_MODULES}
+    saved_environment = {variable: os.environ.get(variable) for variable in environment}
+    sys.modules.update(sim_paho_modules(broker, name))
+    os.environ.update(environment)
+    try:
+        spec = importlib.util.spec_from_file_location(f"mesh_node_{name}", NODE_SCRIPT)
+        node = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(node)
+    finally:
+        for module, previous in saved_modules.items():
+            if previous is None:
+                sys.modules.pop(module, None)
+            else:
+                sys.modules[module] = previous
+        for variable, previous in saved_environment.items():
+            if previous is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = previous
+    node.time = SimClock(broker.loop, epoch)
+    return node
+
+
+# Topologies: graphs over node names n0, n1, ... with a 'latency' on every link.
+# The gateways are the first nodes (one end of a line, a corner of a grid).
+def make_topology(kind, size, radius, seed):
+    rng = random.Random(seed)
+    low, high = LINK_LATENCY_RANGE
+    if kind == 'line':
+        graph = nx.path_graph(size)
+    elif kind == 'grid':
+        side = math.ceil(math.sqrt(size))
+        graph = nx.convert_node_labels_to_integers(nx.grid_2d_graph(side, math.ceil(size / side)))
+    elif kind == 'random':
+        graph = nx.random_geometric_graph(size, radius, seed=seed)
+    else:
+        raise ValueError(f"Unknown topology {kind}")
+    for u, v in graph.edges:
+        if kind == 'random':
+            distance = math.dist(graph.nodes[u]['pos'], graph.nodes[v]['pos'])
+            graph[u][v]['latency'] = low + (high - low) * distance / radius
+        else:
+            graph[u][v]['latency'] = rng.uniform(low, high)
+    return nx.relabel_nodes(graph, {index: f"n{index}" for index in graph.nodes})
+
+
+def gateway_route(node):
+    return node.route_next_hop(node.NODE_NAME, None)
+
+
+async def run_simulation(loop, graph, gateways, args):
+    broker = SimBroker(loop, graph)
+    state_root = tempfile.mkdtemp(prefix='mesh_sim_')
+    epoch = time.time()
+    nodes = {}
+    for name in graph.nodes:
+        state_dir = os.path.join(state_root, name)
+        os.makedirs(state_dir)
+        node = nodes[name] = load_node(name, gateways, broker, state_dir, epoch)
+        node.MAX_CONNECTIONS = args.max_connections
+        node.RELIABLE_LINKS = args.reliable
+
+    # Only nodes with a physical path to a gateway can ever get a route
+    reachable = set()
+    for gateway in gateways:
+        reachable |= nx.node_connected_component(graph, gateway)
+    routed_nodes = [name for name in graph.nodes if name in reachable and name not in gateways]
+
+    for node in nodes.values():
+        node.start_node(loop)
+
+    # Converged once every reachable node has a route and none changed for SETTLE_TIME;
+    # the control traffic is counted up to the last change
+    routes = None
+    changed_at = converged_at = None
+    while loop.time() < args.duration:
+        await asyncio.sleep(CHECK_INTERVAL)
+        current = {name: gateway_route(nodes[name]) for name in routed_nodes}
+        if current != routes:
+            routes, changed_at = current, loop.time()
+            control_messages, control_counts = broker.control_messages(), dict(broker.counts)
+        if all(routes.values()) and loop.time() - changed_at >= SETTLE_TIME:
+            converged_at = changed_at
+            break
+
+    # End-to-end latency of messages from every routed node to the nearest gateway
+    sent = {}
+    received = {}
+    for gateway in gateways:
+        nodes[gateway].handle_received_message = record_delivery(nodes[gateway], loop, received)
+    for index in range(args.messages):
+        for name in routed_nodes:
+            text = f"sim {name} {index}"
+            sent[text] = loop.time()
+            nodes[name].forward_message_to_next_hop(text, name)
+        await asyncio.sleep(MESSAGE_INTERVAL)
+    await asyncio.sleep(args.drain_time)
+
+    for node in nodes.values():
+        node.client.disconnect()
+    for task in asyncio.all_tasks(loop):
+        if task is not asyncio.current_task():
+            task.cancel()
+    delays = [received[text] - sent[text] for text in sent if text in received]
+    return {'nodes': len(graph), 'links': graph.number_of_edges(), 'unreachable': len(graph) - len(reachable),
+            'routed_nodes': len(routed_nodes),
+            'converged_at': converged_at, 'routes': routes, 'control_messages': control_messages,
+            'control_counts': control_counts, 'sent': len(sent), 'delays': delays, 'state_dir': state_root}
+
+
+def record_delivery(node, loop, received):
+    handle = node.handle_received_message
+
+    def record(message):
+        received.setdefault(message, loop.time())
+        handle(message)
+    return record
+
+
+def print_report(result):
+    print(f"Nodes: {result['nodes']}, links: {result['links']}, nodes that need a route: {result['routed_nodes']}")
+    if result['unreachable']:
+        print(f"{result['unreachable']} nodes have no physical path to a gateway and are left out")
+    if result['converged_at'] is None:
+        missing = [name for name, hop in (result['routes'] or {}).items() if not hop]
+        print(f"Did not converge; {len(missing)} nodes without a route: {', '.join(missing)}")
+    else:
+        print(f"Converged after {result['converged_at']:.2f} s")
+    per_node = result['control_messages'] / result['nodes']
+    print(f"Control messages until the last route change: {result['control_messages']} ({per_node:.1f} per node)")
+    for prefix, count in sorted(result['control_counts'].items(), key=lambda item: -item[1]):
+        if prefix not in DATA_TOPICS:
+            print(f"  {prefix}: {count}")
+    delays = sorted(result['delays'])
+    print(f"Messages delivered: {len(delays)} of {result['sent']}")
+    if delays:
+        p95 = delays[min(len(delays) - 1, int(0.95 * len(delays)))]
+        print(f"End-to-end latency: mean {statistics.mean(delays) * 1000:.1f} ms, "
+              f"median {statistics.median(delays) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, "
+              f"max {delays[-1] * 1000:.1f} ms")
+    print(f"Node state written to {result['state_dir']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a mesh of dynamic routing nodes in one process")
+    parser.add_argument('topology', choices=['line', 'grid', 'random'])
+    parser.add_argument('-n', '--nodes', type=int, default=10)
+    parser.add_argument('--radius', type=float, default=0.3, help="link range for random geometric topologies")
+    parser.add_argument('--gateways', type=int, default=1)
+    parser.add_argument('--max-connections', type=int, default=4)
+    parser.add_argument('--reliable', action='store_true', help="use hop-by-hop reliable links")
+    parser.add_argument('--messages', type=int, default=5, help="test messages per node after convergence")
+    parser.add_argument('--duration', type=float, default=600.0, help="virtual seconds to wait for convergence")
+    parser.add_argument('--drain-time', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-v', '--verbose', action='store_true', help="show the nodes' own output")
+    args = parser.parse_args()
+
+    graph = make_topology(args.topology, args.nodes, args.radius, args.seed)
+    gateways = [f"n{index}" for index in range(args.gateways)]
+    loop = VirtualTimeLoop()
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        try:
+            result = loop.run_until_complete(run_simulation(loop, graph, gateways, args))
+        finally:
+            loop.close()
+    print_report(result)
+    print(f"Simulated {loop.now:.1f} s in {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import struct
+import sys
+import time
+
+# Prints the received-message logs written by 3-Dynamicrouting.py. Binary logs start with
+# MESSAGE_LOG_MAGIC and hold MESSAGE_RECORD records; text logs are printed as they are.
+# Both constants must match the ones in 3-Dynamicrouting.py.
+MESSAGE_LOG_MAGIC = b'\xb1MLOG1'
+MESSAGE_RECORD = struct.Struct("!dI")  # Receive time, text length; the UTF-8 text follows
+
+
+def read_binary_records(data, path):
+    offset = len(MESSAGE_LOG_MAGIC)
+    while offset < len(data):
+        if offset + MESSAGE_RECORD.size > len(data):
+            break
+        received, length = MESSAGE_RECORD.unpack_from(data, offset)
+        start = offset + MESSAGE_RECORD.size
+        if start + length > len(data):
+            break
+        yield received, str(data[start:start + length], 'utf-8', 'replace')
+        offset = start + length
+    if offset < len(data):
+        # The writer was stopped in the middle of a flush
+        print(f"{path}: ignoring {len(data) - offset} bytes of an incomplete record", file=sys.stderr)
+
+
+def print_log(path, since=None):
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(MESSAGE_LOG_MAGIC):
+        sys.stdout.write(data.decode('utf-8', 'replace'))
+        return
+    for received, text in read_binary_records(data, path):
+        if since is None or received >= since:
+            print(f"{time.ctime(received)}: {text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print received-message logs, oldest file first")
+    parser.add_argument('paths', nargs='*', default=['received_messages.bin'])
+    parser.add_argument('--since', type=float, help="only binary records received at or after this Unix time")
+    args = parser.parse_args()
+    for path in args.paths:
+        try:
+            print_log(path, args.since)
+        except OSError as e:
+            print(f"Cannot read {path}: {e}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()